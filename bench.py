@@ -0,0 +1,271 @@
+#!/usr/bin/python
+"""Benchmarks the terminal pipeline without a PTY or network. Byte streams
+are fed through Terminal.char_processor chunk by chunk, each chunk standing
+for one read from the PTY and followed by one frame."""
+import sys
+import time
+import random
+import getopt
+import json
+import board
+import delta
+import terminal
+import transport
+import simulator
+import recording
+
+CHUNK_SIZE=4096 # for recorded streams and cat
+
+def shell_workload(rng):
+    """Prompts, commands echoed key by key, and their output."""
+    chunks=[]
+    commands=("ls -l", "git status", "make", "cat notes.txt", "df -h")
+    for i in range(300):
+        chunks.append("user@board:~$ ")
+        for c in rng.choice(commands):
+            chunks.append(c)
+        output=["\r\n"]
+        for j in range(rng.randint(0, 12)):
+            output.append("%-20s %8d Oct 18 12:%02d\r\n" % ("file%d.txt" % j,
+                rng.randint(0, 99999), rng.randint(0, 59)))
+        chunks.append("".join(output))
+    return chunks
+
+def top_workload(rng):
+    """Full screen refreshes with cursor addressing and line clearing."""
+    chunks=[]
+    for i in range(300):
+        out=["\x1b[H", "top - 12:%02d:%02d up 3 days, load average: %.2f"
+            % (i/60%60, i%60, rng.random()*4), "\x1b[K\r\n",
+            "Tasks: %d total, %d running\x1b[K\r\n"
+            % (rng.randint(100, 200), rng.randint(1, 9)),
+            "\x1b[K\r\n\x1b[7m  PID USER      %CPU %MEM COMMAND"
+            "\x1b[K\x1b[m\r\n"]
+        for j in range(board.DSP_HEIGHT-5):
+            out.append("%5d %-8s %5.1f %4.1f %s\x1b[K\r\n" % (
+                rng.randint(1, 32767), rng.choice(("root", "user", "www")),
+                rng.random()*100, rng.random()*10,
+                rng.choice(("python", "bash", "Xvfb", "sshd", "cron"))))
+        out.append("\x1b[K")
+        chunks.append("".join(out))
+    return chunks
+
+def vim_workload(rng):
+    """Scrolling a file up and down inside a scroll region, with a status
+    line."""
+    chunks=["\x1b[H\x1b[2J\x1b[1;%dr" % (board.DSP_HEIGHT-1)]
+    words=("def", "return", "self", "import", "for", "in", "if", "else")
+    line=0
+    for i in range(600):
+        text=" ".join([rng.choice(words) for j in range(rng.randint(1, 8))])
+        if i%200<120:
+            line+=1
+            out="\x1b[%d;1H\n%s" % (board.DSP_HEIGHT-1, text)
+        else:
+            line-=1
+            out="\x1b[1;1H\x1bM%s" % text
+        out+="\x1b[%d;1H\x1b[7m%-30s%10d,1\x1b[m\x1b[K" % (board.DSP_HEIGHT,
+            "main.py", line)
+        chunks.append(out)
+    chunks.append("\x1b[r")
+    return chunks
+
+def cat_workload(rng):
+    """A large log file written as fast as possible."""
+    lines=[]
+    for i in range(40000):
+        lines.append("2026-10-18 12:%02d:%02d host%d kernel: [%8.3f] eth0: %s"
+            "\r\n" % (i/60%60, i%60, rng.randint(1, 9), i*0.013,
+            rng.choice(("link up", "link down", "rx overrun", "tx timeout"))))
+    data="".join(lines)
+    return [data[i:i+CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)]
+
+def tail_workload(rng):
+    """tail -f of a log, one line per read."""
+    chunks=[]
+    for i in range(2000):
+        chunks.append("2026-10-18 12:%02d:%02d host%d sshd[%d]: %s\r\n" % (
+            i/60%60, i%60, rng.randint(1, 9), rng.randint(100, 32767),
+            rng.choice(("Accepted publickey for user", "Connection closed",
+            "Invalid user admin", "Disconnected from 10.0.0.%d"
+            % rng.randint(1, 254)))))
+    return chunks
+
+def ncurses_workload(rng):
+    """A dashboard: boxes drawn once, then fields updated in place."""
+    chunks=["\x1b[H\x1b[2J"+"".join(["\x1b[%d;1H+%s+" % (y, "-"*26)
+        for y in (1, 10, 20)])]
+    for i in range(1000):
+        out=[]
+        for j in range(rng.randint(1, 6)):
+            out.append("\x1b[%d;%dH\x1b[%dm%6.2f\x1b[0m" % (
+                rng.randint(2, 19), rng.randint(2, 45),
+                rng.choice((0, 1, 31, 32, 33)), rng.random()*1000))
+        chunks.append("".join(out))
+    return chunks
+
+WORKLOADS=(("shell", shell_workload), ("top", top_workload),
+    ("vim", vim_workload), ("cat", cat_workload), ("tail", tail_workload),
+    ("ncurses", ncurses_workload))
+
+class CountingTransport:
+    """Counts the datagrams passed on to another transport."""
+    def __init__(self, inner):
+        self.sock=None
+        self.address=None
+        self.inner=inner
+        self.packets=0
+        self.bytes=0
+
+    def send(self, message):
+        self.packets+=1
+        self.bytes+=len(message)
+        self.inner.send(message)
+
+    def recv(self):
+        return self.inner.recv()
+
+def percentile(values, p):
+    values=sorted(values)
+    return values[int(p*(len(values)-1))]
+
+def run(chunks, colored=False, loopback=False, pixel=False):
+    """Replays chunks through a headless Terminal, in pixel mode if pixel.
+    Returns the results as a dictionary."""
+    t=terminal.Terminal(spawn=False)
+    t.colored=colored
+    if loopback:
+        counter=CountingTransport(
+            transport.LoopbackTransport(simulator.Simulator(quiet=True)))
+    else:
+        counter=transport.NullTransport()
+    t.board=board.Board(transport=counter)
+    if pixel:
+        t.use_pixels()
+
+    parse_time=0
+    latencies=[]
+    total=0
+    for chunk in chunks:
+        start=time.time()
+        t.char_processor(chunk)
+        parsed=time.time()
+        t.delta_transmit()
+        latencies.append(time.time()-parsed)
+        parse_time+=parsed-start
+        total+=len(chunk)
+    elapsed=parse_time+sum(latencies)
+    return {
+        "bytes_in": total,
+        "parse_mb_s": total/parse_time/1e6 if parse_time else 0,
+        "frames_s": len(chunks)/elapsed if elapsed else 0,
+        "bytes_per_frame": float(counter.bytes)/len(chunks),
+        "packets_per_frame": float(counter.packets)/len(chunks),
+        "p50_ms": percentile(latencies, 0.5)*1000,
+        "p99_ms": percentile(latencies, 0.99)*1000,
+    }
+
+def shown(sim):
+    """Returns the framebuffer of a simulator as it looks: the luminance of
+    blank cells does not show."""
+    char, lum = sim.framebuffer()
+    return char, str(delta.lum_planes(char, lum, lum)[1])
+
+def verify(chunks, colored=False):
+    """Sends every frame both through the delta encoder and as a full frame
+    into two simulators. Returns the number of frames after which their
+    framebuffers differ in what shows."""
+    t=terminal.Terminal(spawn=False)
+    delta_sim=simulator.Simulator(quiet=True)
+    full_sim=simulator.Simulator(quiet=True)
+    delta_board=board.Board(transport=transport.LoopbackTransport(delta_sim))
+    full_board=board.Board(transport=transport.LoopbackTransport(full_sim))
+    mismatches=0
+    for chunk in chunks:
+        t.char_processor(chunk)
+        t.display.delta_transmit(delta_board, t.transmitted_display, colored)
+        t.display.nu_delta_transmit(full_board, None, colored)
+        if shown(delta_sim)!=shown(full_sim):
+            mismatches+=1
+    if delta_sim.invalid:
+        mismatches+=1
+    return mismatches
+
+def usage():
+    print "Usage: bench.py [-c|--colored] [-l|--loopback] [-j|--json]" \
+        " [-v|--verify] [-P|--pixel] [-r|--recording FILE]... [WORKLOAD]..."
+    print
+    print "Workloads: %s. A recording of terminal.py --record is replayed" \
+        % ", ".join([name for name, f in WORKLOADS])
+    print "read by read, a raw PTY byte stream in %d byte chunks." % CHUNK_SIZE
+    print "--loopback sends into an in-process simulator."
+    print "--verify checks that the delta encoder leaves the same image on the"
+    print "simulated wall as full frames. --pixel runs the pixel mode text"
+    print "renderer instead of the text mode encoder."
+
+def main():
+    colored=False
+    loopback=False
+    as_json=False
+    verify_only=False
+    pixel=False
+    recordings=[]
+    try:
+        opts, args=getopt.getopt(sys.argv[1:], "hcljvPr:",
+            ("help", "colored", "loopback", "json", "verify", "pixel",
+            "recording="))
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(1)
+    for o, a in opts:
+        if o in ("-h", "--help"): usage(); return
+        if o in ("-c", "--colored"): colored=True
+        if o in ("-l", "--loopback"): loopback=True
+        if o in ("-j", "--json"): as_json=True
+        if o in ("-v", "--verify"): verify_only=True
+        if o in ("-P", "--pixel"): pixel=True
+        if o in ("-r", "--recording"): recordings.append(a)
+    workloads=dict(WORKLOADS)
+    for name in args:
+        if name not in workloads:
+            usage()
+            sys.exit(1)
+    if not args and not recordings:
+        args=[name for name, f in WORKLOADS]
+
+    runs=[]
+    for name in args:
+        runs.append((name, workloads[name](random.Random(23))))
+    for path in recordings:
+        if recording.is_recording(path):
+            runs.append((path, recording.Recording(path).pty_chunks()))
+            continue
+        data=open(path, "rb").read()
+        runs.append((path, [data[i:i+CHUNK_SIZE]
+            for i in range(0, len(data), CHUNK_SIZE)]))
+
+    if verify_only:
+        failed=False
+        for name, chunks in runs:
+            mismatches=verify(chunks, colored)
+            print "%-12s %s" % (name, mismatches and
+                "%d frames differ" % mismatches or "ok")
+            failed=failed or mismatches
+        sys.exit(failed and 1 or 0)
+
+    if not as_json:
+        print "%-12s %8s %9s %9s %9s %8s %8s" % ("workload", "MB/s",
+            "frames/s", "B/frame", "pkt/frame", "p50 ms", "p99 ms")
+    for name, chunks in runs:
+        result=run(chunks, colored, loopback, pixel)
+        if as_json:
+            result["workload"]=name
+            print json.dumps(result, sort_keys=True)
+        else:
+            print "%-12s %8.2f %9.0f %9.1f %9.2f %8.3f %8.3f" % (name,
+                result["parse_mb_s"], result["frames_s"],
+                result["bytes_per_frame"], result["packets_per_frame"],
+                result["p50_ms"], result["p99_ms"])
+
+if __name__=="__main__": main()
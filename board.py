@@ -1,9 +1,13 @@
 #!/usr/bin/python
 import socket
 import struct
-import select
 import time
 import random
+import asyncore
+import collections
+import errno
+import metrics
+from transport import UdpTransport
 CMD_ACK=0
 CMD_NAK=1 
 CMD_CLEAR=2 # DONE
@@ -16,24 +20,508 @@ CMD_RESET=8 # DONE
 CMD_READ_RAW=9
 CMD_READ_LUM_RAW=10
 CMD_HARDRESET=11 # DONE
+CMD_REFRESH=17 # pixel mode, see x/ledwand.h
+CMD_LED_DRAW=18
+
+COMMAND_NAMES={CMD_ACK: "ack", CMD_NAK: "nak", CMD_CLEAR: "clear",
+    CMD_WRITE_RAW: "write_raw", CMD_WRITE_STD: "write_std",
+    CMD_WRITE_LUM_RAW: "write_lum_raw", CMD_WRITE_LUM_STD: "write_lum_std",
+    CMD_INTENSITY: "intensity", CMD_RESET: "reset",
+    CMD_READ_RAW: "read_raw", CMD_READ_LUM_RAW: "read_lum_raw",
+    CMD_HARDRESET: "hardreset", CMD_REFRESH: "refresh",
+    CMD_LED_DRAW: "led_draw"}
 
 LUM_MAX=8
 LUM_MIN=0
 DSP_HEIGHT = 20
 DSP_WIDTH = 56
 
+PACKET_OVERHEAD=11 # header + trailer bytes added by Board.send
+HEADER=struct.Struct("!HHHHH") # command, x, y, width, height
+MAX_PACKET=65507 # largest UDP payload
+
+# pixel mode: one bit per LED, MSB first, row after row
+CELL_PIXEL_WIDTH=8
+CELL_PIXEL_HEIGHT=12
+PIXEL_WIDTH=DSP_WIDTH*CELL_PIXEL_WIDTH
+PIXEL_HEIGHT=DSP_HEIGHT*CELL_PIXEL_HEIGHT
+PIXEL_BYTES=PIXEL_WIDTH*PIXEL_HEIGHT/8
+PIXEL_PARTS=14 # CMD_LED_DRAW packets per frame
+PIXEL_PART_SIZE=PIXEL_BYTES/PIXEL_PARTS
+
+# writes that go through the AckWindow in reliable mode
+ACKED_COMMANDS=(CMD_WRITE_RAW, CMD_WRITE_LUM_RAW, CMD_LED_DRAW)
+# writes the Pacer may reorder: each replaces a region of the board
+RAW_COMMANDS=(CMD_WRITE_RAW, CMD_WRITE_LUM_RAW, CMD_LED_DRAW)
+
+# priority classes of the Pacer, see priority
+PRIORITY_INTERACTIVE=0
+PRIORITY_BULK=1
+PRIORITY_LUM=2
+PRIORITIES=3
+INTERACTIVE_CELLS=DSP_WIDTH # character writes up to this size are edits
+
+PACE_PACKETS=2500 # per second, as usleep(400) between parts in x/ledwand.c
+PACE_BURST=0.004 # seconds of the rates a token bucket holds
+
+PACKETS={} # command -> counter of packets sent, see count_sent
+SENT_BYTES={}
+for command, name in COMMAND_NAMES.items():
+    PACKETS[command]=metrics.registry.counter("board_packets_total",
+        command=name)
+    SENT_BYTES[command]=metrics.registry.counter("board_bytes_total",
+        command=name)
+LOST=metrics.registry.counter("board_lost_total")
+DROPPED=metrics.registry.counter("board_dropped_total")
+SENDTO_TIME=metrics.registry.histogram("stage_seconds", stage="sendto")
+PACER_TIME=metrics.registry.histogram("stage_seconds", stage="pacer")
+SUPERSEDED=metrics.registry.counter("pacer_superseded_total")
+PATCHED=metrics.registry.counter("pacer_patched_total")
+
+ACK_WINDOW=16 # datagrams in flight in reliable mode
+ACK_PENDING=256 # datagrams waiting for the window, older ones count as lost
+QUEUE_MAX=1024 # datagrams queued for asyncore, older ones are dropped
+RTO_INITIAL=0.2 # seconds until an unanswered datagram counts as lost
+RTO_MIN=0.02
+RTO_MAX=1.0
+
 NET_PORT=2342
 NET_HOST="172.23.42.29"
 #NET_HOST="localhost"
 
 
+class AckWindow:
+    """Tracks datagrams waiting for the board's CMD_ACK or CMD_NAK. A reply
+    echoes the header fields and the payload, which together identify the
+    datagram. At most size datagrams are in flight, further ones wait.
+
+    Datagrams that are NAKed or time out are not retransmitted, since newer
+    writes may have covered the same cells in the meantime. Their regions
+    are collected in lost instead, so the caller can send what these cells
+    hold now. So are the oldest pending datagrams when more than
+    max_pending wait, so that a board which stopped answering costs bounded
+    memory and one resend of its regions once it is back."""
+    def __init__(self, size=ACK_WINDOW, max_pending=ACK_PENDING):
+        self.size=size
+        self.max_pending=max_pending
+        self.in_flight=[] # [key, region, time sent]
+        self.pending=collections.deque()
+        self.lost=[]
+        self.srtt=None
+        self.rttvar=0
+        self.rto=RTO_INITIAL
+
+    def submit(self, message, key, region):
+        if len(self.pending)>=self.max_pending:
+            self.lost.append(self.pending.popleft()[2])
+        self.pending.append((message, key, region))
+
+    def ready(self, now):
+        """Returns the pending messages that fit into the window, which
+        counts them as sent at now."""
+        messages=[]
+        while self.pending and not self.full():
+            message, key, region = self.pending.popleft()
+            self.track(key, region, now)
+            messages.append(message)
+        return messages
+
+    def full(self):
+        return len(self.in_flight)>=self.size
+
+    def track(self, key, region, now):
+        """Counts a message sent at now, past the pending queue."""
+        self.in_flight.append([key, region, now])
+
+    def acknowledged(self, key, now, ok=True):
+        for entry in self.in_flight:
+            if entry[0]==key: break
+        else:
+            return # late reply for a datagram already counted as lost
+        self.in_flight.remove(entry)
+        if not ok:
+            self.lost.append(entry[1])
+            return
+        rtt=now-entry[2]
+        if self.srtt is None:
+            self.srtt=rtt
+            self.rttvar=rtt/2
+        else:
+            self.rttvar=0.75*self.rttvar+0.25*abs(self.srtt-rtt)
+            self.srtt=0.875*self.srtt+0.125*rtt
+        self.rto=min(RTO_MAX, max(RTO_MIN, self.srtt+4*self.rttvar))
+
+    def expire(self, now):
+        expired=[e for e in self.in_flight if now-e[2]>=self.rto]
+        if not expired: return
+        for entry in expired:
+            self.in_flight.remove(entry)
+            self.lost.append(entry[1])
+        self.rto=min(RTO_MAX, self.rto*2)
+
+    def timeout(self, now):
+        """Seconds until the oldest datagram in flight expires, or None."""
+        if not self.in_flight: return None
+        return max(0, self.in_flight[0][2]+self.rto-now)
+
+    def take_lost(self):
+        lost=self.lost
+        self.lost=[]
+        return lost
+
+def packet_data(message):
+    """Returns the data of a packet, between header and trailer, as a
+    buffer on message rather than a copy. It identifies a raw write in the
+    AckWindow, since the board echoes it in the reply."""
+    return buffer(message, HEADER.size, len(message)-HEADER.size-1)
+
+def count_sent(command, length):
+    """Counts a packet as it goes out, or into the AckWindow."""
+    if command in PACKETS:
+        PACKETS[command].inc()
+        SENT_BYTES[command].inc(length)
+
+def priority(command, width, height):
+    """Returns the priority class of a packet for the Pacer. Small character
+    writes, like the echo of a keystroke and the cursor, go ahead of bulk
+    redraws, and luminance refreshes come last."""
+    if command==CMD_WRITE_LUM_RAW:
+        return PRIORITY_LUM
+    if command==CMD_WRITE_RAW and width*height<=INTERACTIVE_CELLS:
+        return PRIORITY_INTERACTIVE
+    return PRIORITY_BULK
+
+class Pacer:
+    """A token bucket for the datagrams of a Board: on average at most
+    packet_rate packets and byte_rate bytes per second go out, in bursts of
+    PACE_BURST seconds' worth; a rate of None is no limit. Packets that have
+    to wait are queued by priority class, see priority.
+
+    A queued raw write is superseded by a newer one of the same region, and
+    the cells a newer write shares with a queued one of the same plane are
+    copied into it. So no queued packet holds stale cells, and the classes
+    may overtake each other. Other commands, like CMD_CLEAR and CMD_REFRESH,
+    keep their place among all packets."""
+    def __init__(self, packet_rate=PACE_PACKETS, byte_rate=None):
+        self.packet_rate=packet_rate
+        self.byte_rate=byte_rate
+        self.packet_tokens=self.capacity(packet_rate, 1)
+        self.byte_tokens=self.capacity(byte_rate, MAX_PACKET)
+        self.last=time.time()
+        self.queues=[collections.deque() for i in range(PRIORITIES)]
+        self.queued={} # (command, region) -> entry of a raw write
+        self.barriers=collections.deque() # sequence numbers, in order
+        self.sequence=0
+        self.length=0
+
+    def __len__(self):
+        return self.length
+
+    def capacity(self, rate, least):
+        if not rate: return 0
+        return max(least, rate*PACE_BURST)
+
+    def submit(self, packet, command, region, priority, now):
+        """Queues a packet for the region x, y, width, height of
+        send_packet. A memoryview of the builder is copied; a str, as from a
+        Fanout, is shared with the other targets until patch changes it."""
+        self.sequence+=1
+        if isinstance(packet, memoryview):
+            packet=packet.tobytes()
+        # sequence number, message, command, region, time submitted
+        entry=[self.sequence, packet, command, region, now]
+        if command in RAW_COMMANDS:
+            key=(command, region)
+            old=self.queued.get(key)
+            if old is not None:
+                old[1]=None
+                self.length-=1
+                SUPERSEDED.inc()
+            if command!=CMD_LED_DRAW:
+                self.patch(entry)
+            self.queued[key]=entry
+        else:
+            self.barriers.append(self.sequence)
+        self.queues[priority].append(entry)
+        self.length+=1
+
+    def patch(self, new):
+        """Copies the cells of the raw write new into the queued writes of
+        the same plane that it overlaps."""
+        nx, ny, nw, nh = new[3]
+        for queue in self.queues:
+            for entry in queue:
+                if entry[1] is None or entry[2]!=new[2]: continue
+                x, y, w, h = entry[3]
+                x0, x1 = max(x, nx), min(x+w, nx+nw)
+                y0, y1 = max(y, ny), min(y+h, ny+nh)
+                if x0>=x1 or y0>=y1: continue
+                if isinstance(entry[1], str): # shared, see submit
+                    entry[1]=bytearray(entry[1])
+                for row in range(y0, y1):
+                    o=HEADER.size+(row-y)*w+x0-x
+                    n=HEADER.size+(row-ny)*nw+x0-nx
+                    entry[1][o:o+x1-x0]=new[1][n:n+x1-x0]
+                PATCHED.inc()
+
+    def refill(self, now):
+        elapsed=max(0, now-self.last)
+        self.last=now
+        if self.packet_rate:
+            self.packet_tokens=min(self.capacity(self.packet_rate, 1),
+                self.packet_tokens+elapsed*self.packet_rate)
+        if self.byte_rate:
+            self.byte_tokens=min(self.capacity(self.byte_rate, MAX_PACKET),
+                self.byte_tokens+elapsed*self.byte_rate)
+
+    def head(self, queue):
+        while queue and queue[0][1] is None: # superseded
+            queue.popleft()
+        if queue: return queue[0]
+        return None
+
+    def next(self, now):
+        """Returns the entry to send at now, or None if there is none or
+        the bucket is empty. The highest class goes first, unless the
+        oldest queued command that is not a raw write comes before it."""
+        self.refill(now)
+        if not self.length or self.packet_tokens<0 or self.byte_tokens<0:
+            return None
+        barrier=None
+        if self.barriers:
+            barrier=self.barriers[0]
+        for queue in self.queues:
+            entry=self.head(queue)
+            if entry is not None and (barrier is None or entry[0]<barrier):
+                return entry
+        for queue in self.queues:
+            entry=self.head(queue)
+            if entry is not None and entry[0]==barrier:
+                return entry
+
+    def take(self, entry, now):
+        """Removes the entry returned by next, which is sent at now, and
+        returns its message."""
+        for queue in self.queues:
+            if queue and queue[0] is entry:
+                queue.popleft()
+        if self.barriers and self.barriers[0]==entry[0]:
+            self.barriers.popleft()
+        elif self.queued.get((entry[2], entry[3])) is entry:
+            del self.queued[(entry[2], entry[3])]
+        self.length-=1
+        message=str(entry[1])
+        self.spend(len(message))
+        PACER_TIME.observe(now-entry[4])
+        return message
+
+    def admit(self, length, now):
+        """Lets a packet of length bytes go out at now without queueing it,
+        if nothing is queued and the bucket is not empty. Returns whether
+        it did."""
+        if self.length: return False
+        self.refill(now)
+        if self.packet_tokens<0 or self.byte_tokens<0: return False
+        self.spend(length)
+        PACER_TIME.observe(0)
+        return True
+
+    def spend(self, length):
+        if self.packet_rate:
+            self.packet_tokens-=1
+        if self.byte_rate:
+            self.byte_tokens-=length
+
+    def timeout(self, now):
+        """Seconds until the bucket lets the next queued packet go, or
+        None if none is queued."""
+        if not self.length: return None
+        self.refill(now)
+        timeout=0
+        if self.packet_rate and self.packet_tokens<0:
+            timeout=-self.packet_tokens/float(self.packet_rate)
+        if self.byte_rate and self.byte_tokens<0:
+            timeout=max(timeout, -self.byte_tokens/float(self.byte_rate))
+        return timeout
+
+class DatagramDispatcher(asyncore.dispatcher):
+    """Non-blocking datagram output for an asyncore loop. Messages are queued
+    and written whenever the socket is writable, replies are handed to
+    on_reply if given."""
+    def __init__(self, sock, address, map=None, on_reply=None):
+        asyncore.dispatcher.__init__(self, sock, map)
+        self.address=address
+        self.queue=collections.deque()
+        self.on_reply=on_reply
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return len(self.queue)>0
+
+    def handle_connect(self):
+        pass
+
+    def handle_read(self):
+        try:
+            reply=self.socket.recv(4096)
+        except socket.error:
+            return
+        if self.on_reply is not None:
+            self.on_reply(reply)
+
+    def handle_write(self):
+        while self.queue:
+            try:
+                self.socket.sendto(self.queue[0], self.address)
+            except socket.error, err:
+                if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK,
+                        errno.ENOBUFS):
+                    return
+                # dropped, see transport.SocketTransport.send
+            self.queue.popleft()
+
+class PacketBuilder:
+    """Builds one packet at a time in a buffer allocated once. A packet is a
+    memoryview of the buffer and valid until the next one is started."""
+    def __init__(self, size=MAX_PACKET):
+        self.buffer=bytearray(size)
+        self.view=memoryview(self.buffer)
+        self.length=0
+
+    def start(self, command, x=0, y=0, width=0, height=0):
+        HEADER.pack_into(self.buffer, 0, command, x, y, width, height)
+        self.length=HEADER.size
+
+    def append(self, data):
+        end=self.length+len(data)
+        if end>=len(self.buffer): # the trailer must fit, too
+            raise ValueError("packet exceeds %d bytes" % len(self.buffer))
+        self.buffer[self.length:end]=data
+        self.length=end
+
+    def append_rect(self, plane, stride, x, y, width, height):
+        """Appends the width x height rectangle at x, y of a flat plane
+        with rows of stride bytes."""
+        view=memoryview(plane)
+        for o in range(y*stride+x, (y+height)*stride, stride):
+            self.append(view[o:o+width])
+
+    def finish(self):
+        self.buffer[self.length]=0 # trailer
+        self.length+=1
+        return self.view[:self.length]
+
 class Board:
-    def __init__(self, host=NET_HOST, port=NET_PORT, dry_run=False):
+    def __init__(self, host=NET_HOST, port=NET_PORT, dry_run=False,
+            reliable=False, transport=None, pacer=None):
+        """Talks UDP to host unless another transport is given, see
+        transport.py. In reliable mode, raw writes are tracked until the
+        board acknowledges them; call poll regularly and resend the regions
+        returned by take_lost. With a Pacer, packets are queued and sent as
+        it lets them through; call poll regularly, too."""
         self.dry_run=dry_run
-        self.sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
-        self.host = (host, port)
+        if transport is None:
+            transport=UdpTransport(host, port)
+        self.transport=transport
+        self.sock=transport.sock # None for in-process transports
 #        self.timeout = 3 # seconds
         self.timeout=0.1
+        self.dispatcher=None
+        self.builder=PacketBuilder()
+        self.recorder=None # see recording.Recorder
+        self.targets=[self] # the boards written to, see Fanout
+        self.pacer=pacer
+        self.window=None
+        if reliable:
+            self.window=AckWindow()
+
+    def reliable(self):
+        """Whether lost raw writes are reported, see take_lost. Nothing
+        else is tracked."""
+        return self.window is not None
+
+    def attach(self, map=None):
+        """Hands the socket to an asyncore loop; send only queues from now
+        on. Transports without a socket stay synchronous."""
+        if self.sock is None: return
+        self.dispatcher=DatagramDispatcher(self.sock, self.transport.address,
+            map, self.reply_received)
+
+    def flush(self):
+        """Blocks until everything queued by send is written, at the pace
+        of the pacer but without waiting for the AckWindow."""
+        while self.pacer:
+            time.sleep(self.pacer.timeout(time.time()))
+            self.pump(time.time(), False)
+        if self.dispatcher is None: return
+        self.sock.setblocking(1)
+        self.dispatcher.handle_write()
+        self.sock.setblocking(0)
+
+    def poll(self):
+        """Reliable mode: handles replies, expires unanswered datagrams and
+        sends the ones waiting for room in the window. Sends what the pacer
+        lets through. Returns the seconds until it needs to be called
+        again, or None."""
+        timeout=None
+        now=time.time()
+        if self.window is not None:
+            if self.dispatcher is None:
+                reply=self.transport.recv()
+                while reply is not None:
+                    self.reply_received(reply)
+                    reply=self.transport.recv()
+            now=time.time()
+            self.window.expire(now)
+            for message in self.window.ready(now):
+                self.transmit(message)
+            timeout=self.window.timeout(now)
+        if self.pacer is not None and self.pump(now):
+            t=self.pacer.timeout(now)
+            if t is not None and (timeout is None or t<timeout):
+                timeout=t
+        return timeout
+
+    def pump(self, now, wait_for_window=True):
+        """Sends the packets the pacer lets through at now. Returns False
+        if they wait for room in the AckWindow, which replies make."""
+        while True:
+            entry=self.pacer.next(now)
+            if entry is None: return True
+            command, region = entry[2], entry[3]
+            acked=self.window is not None and command in ACKED_COMMANDS
+            if acked and wait_for_window and self.window.full():
+                return False
+            self.release(command, region, self.pacer.take(entry, now), now)
+
+    def release(self, command, region, message, now):
+        """Sends a packet the pacer let through at now. Superseded packets
+        never get here, so only what goes out is counted."""
+        if self.window is not None and command in ACKED_COMMANDS:
+            if isinstance(message, memoryview): # outlives the builder
+                message=message.tobytes()
+            self.window.track(region+(packet_data(message),),
+                (command,)+region, now)
+        count_sent(command, len(message))
+        self.transmit(message)
+
+    def reply_received(self, reply):
+        if self.window is None or len(reply)<10: return
+        command, x, y, width, height = struct.unpack("!HHHHH", reply[0:10])
+        if command not in (CMD_ACK, CMD_NAK): return
+        self.window.acknowledged((x, y, width, height, packet_data(reply)),
+            time.time(), command==CMD_ACK)
+
+    def take_lost(self):
+        """Returns (command, x, y, width, height) of the writes that were
+        not acknowledged since the last call."""
+        if self.window is None: return []
+        lost=self.window.take_lost()
+        LOST.inc(len(lost))
+        return lost
+
     def write(self, text, x=0, y=0, lum=-1):
         """Writes some string to board - use display_chars instead!"""
         if lum > -1: # -1 = dont change
@@ -65,53 +553,180 @@ class Board:
         self.display_luminance(lum_array, x, y)
         self.display_chars(char_array, x, y)
 
-    def display_luminance(self, buffer, x=0, y=0):
+    def display_luminance(self, buffer, x=0, y=0, width=None):
         """Set luminance for sepecific cells.
-        example: [["a", "b", "c"], ["d", "b", "f"]]"""
-        columns = len(buffer[0])
-        # TODO: Check type!
-        rows = len(buffer)
-        data = ""
-        for r in buffer:
-            for c in r:
-                data+=struct.pack("b", c)
-        self.send(CMD_WRITE_LUM_RAW, x, y, columns, rows, data)
-
-    def display_chars(self, buffer, x=0, y=0):
-        """example: [["a", "b", "c"], ["d", "b", "f"]]"""
-        columns = len(buffer[0])
-        # TODO: Check type!
-        rows = len(buffer)
-        data = ""
+        example: [[8, 3, 3], [0, 8, 8]]
+        Rows may also be strings or bytearrays, or with width, buffer is
+        a flat plane with rows of width bytes."""
+        self.display_grid(CMD_WRITE_LUM_RAW, buffer, x, y, width)
+
+    def display_chars(self, buffer, x=0, y=0, width=None):
+        """example: [["a", "b", "c"], ["d", "b", "f"]]
+        Rows may also be strings or bytearrays, or with width, buffer is
+        a flat plane with rows of width bytes."""
+        self.display_grid(CMD_WRITE_RAW, buffer, x, y, width)
+
+    def display_grid(self, command, buffer, x, y, width):
+        if self.dry_run: return
+        if width is not None:
+            self.write_rect(command, buffer, width, x, y, width,
+                len(buffer)/width)
+            return
+        self.builder.start(command, x, y, len(buffer[0]), len(buffer))
         for r in buffer:
-            for c in r:
-                data+=c
-        self.send(CMD_WRITE_RAW, x, y, columns, rows, data)
-        
+            if isinstance(r, list):
+                r=bytearray([c&0xff if isinstance(c, int) else ord(c)
+                    for c in r])
+            self.builder.append(r)
+        self.send_packet(command, x, y, len(buffer[0]), len(buffer),
+            self.builder.finish())
+
+    def write_rect(self, command, plane, stride, x, y, width, height):
+        """Sends the width x height rectangle at x, y of a flat plane with
+        rows of stride bytes to x, y on the board, straight from the plane
+        into the packet."""
+        if self.dry_run: return
+        self.builder.start(command, x, y, width, height)
+        self.builder.append_rect(plane, stride, x, y, width, height)
+        self.send_packet(command, x, y, width, height,
+            self.builder.finish())
+
+    def draw_part(self, offset, data):
+        """Pixel mode: writes data into the bitmap at the byte offset."""
+        self.send(CMD_LED_DRAW, offset, len(data), 0, 0, data)
+
+    def draw_bitmap(self, bitmap):
+        """Pixel mode: sends a whole PIXEL_BYTES bitmap in PIXEL_PARTS
+        parts, without pacing. See pixelstream.PixelStream."""
+        for offset in range(0, PIXEL_BYTES, PIXEL_PART_SIZE):
+            self.draw_part(offset, bitmap[offset:offset+PIXEL_PART_SIZE])
+
+    def refresh(self):
+        self.send(CMD_REFRESH)
+
     def clear(self):
         self.send(CMD_CLEAR)
         self.set_luminance(LUM_MAX)
 
     def send(self, command, x=0, y=0, width=0, height=0, data=""):
-        """returns 0 if successful, 1 if timed out"""
+        """Always returns 0, see take_lost for reliable mode."""
         if self.dry_run: return 0
-        message= \
-            struct.pack("!HHHHH", command, x, y, width, height) \
-            + data \
-            + struct.pack("b", 0)
-        self.sock.sendto(message,self.host)
-        return 0
-        r, w, x = select.select([self.sock], [], [],3)
-        # reset has no answer
-        if command in (CMD_HARDRESET, CMD_RESET):
-            return 0
-        if r==[]:
-            # print "No answer received.... x("
-            return 1
-        else:
-            answer, host = self.sock.recvfrom(4096)
+        self.builder.start(command, x, y, width, height)
+        self.builder.append(data)
+        self.send_packet(command, x, y, width, height, self.builder.finish())
         return 0
 
+    def send_packet(self, command, x, y, width, height, packet):
+        """Sends a packet of the builder. It is only copied where it has to
+        outlive the next packet: in the pacer queue, the AckWindow and the
+        asyncore queue. A packet the pacer need not hold back goes out
+        directly."""
+        if self.pacer is not None:
+            now=time.time()
+            region=(x, y, width, height)
+            acked=self.window is not None and command in ACKED_COMMANDS
+            if not (acked and self.window.full()) \
+                    and self.pacer.admit(len(packet), now):
+                self.release(command, region, packet, now)
+                return
+            self.pacer.submit(packet, command, region,
+                priority(command, width, height), now)
+            self.pump(now)
+            return
+        count_sent(command, len(packet))
+        if self.window is not None and command in ACKED_COMMANDS:
+            message=packet
+            if isinstance(message, memoryview):
+                message=message.tobytes()
+            self.window.submit(message,
+                (x, y, width, height, packet_data(message)),
+                (command, x, y, width, height))
+            self.poll()
+            return
+        self.transmit(packet)
+
+    def transmit(self, message):
+        if self.recorder is not None:
+            self.recorder.packet(message)
+        if self.dispatcher is not None:
+            if isinstance(message, memoryview):
+                message=message.tobytes()
+            if len(self.dispatcher.queue)>=QUEUE_MAX: # the board stalls
+                self.dispatcher.queue.popleft()
+                DROPPED.inc()
+            self.dispatcher.queue.append(message)
+            return
+        with SENDTO_TIME:
+            self.transport.send(message)
+
+class Fanout(Board):
+    """Sends the same frames to several boards, e.g. the wall, a simulator
+    on the projector PC and another one on a Unix socket. A packet is built
+    once, in the builder of the fan-out, and copied once, into a str that
+    the targets and their pacers share.
+
+    Each target keeps its own transport, asyncore queue and, in reliable
+    mode, AckWindow, and its socket does not block, so a target that is
+    slow or loses packets never holds up the others. The writes a target
+    lost come from its own take_lost and are meant to be resent to it
+    alone, see terminal.TermBuffer.resend."""
+    def __init__(self, targets):
+        self.targets=targets
+        self.dry_run=False
+        self.transport=None
+        self.sock=None
+        self.dispatcher=None
+        self.builder=PacketBuilder()
+        self.recorder=None
+        self.pacer=None # each target has its own
+        self.window=None
+        for target in targets:
+            if target.sock is not None:
+                target.sock.setblocking(0) # a full socket drops datagrams
+
+    def reliable(self):
+        for target in self.targets:
+            if target.reliable():
+                return True
+        return False
+
+    def attach(self, map=None):
+        for target in self.targets:
+            target.attach(map)
+
+    def flush(self):
+        for target in self.targets:
+            target.flush()
+
+    def poll(self):
+        timeout=None
+        for target in self.targets:
+            t=target.poll()
+            if t is not None and (timeout is None or t<timeout):
+                timeout=t
+        return timeout
+
+    def take_lost(self):
+        """Returns the lost writes of all targets."""
+        lost=[]
+        for target in self.targets:
+            lost+=target.take_lost()
+        return lost
+
+    def send_packet(self, command, x, y, width, height, packet):
+        message=packet.tobytes()
+        if self.recorder is not None:
+            self.recorder.packet(message)
+        for target in self.targets:
+            if not target.dry_run:
+                target.send_packet(command, x, y, width, height, message)
+
+    def transmit(self, message):
+        if self.recorder is not None:
+            self.recorder.packet(message)
+        for target in self.targets:
+            target.transmit(message)
+
 def brightness_demo():
     b=Board()
     b.clear()
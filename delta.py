@@ -0,0 +1,169 @@
+"""Dirty-rectangle delta encoding of board frames.
+
+Finds the cells in which two grids differ and covers them with a small set of
+rectangles, each of which can be sent with one CMD_WRITE_RAW or
+CMD_WRITE_LUM_RAW packet."""
+import re
+import board
+
+DATAGRAM_OVERHEAD=28 # IPv4 and UDP headers
+BLANK_RE=re.compile(" +")
+NO_LUM=0xff # a cell whose luminance does not show, see lum_planes
+NO_LUM_CELLS=bytearray(chr(NO_LUM)*board.DSP_WIDTH*board.DSP_HEIGHT)
+
+def packet_cost(width, height):
+    """Bytes on the wire for a raw write of a width x height rectangle."""
+    return board.PACKET_OVERHEAD+width*height
+
+def datagram_cost(width, height):
+    """Like packet_cost, but counting the IP and UDP headers as well."""
+    return DATAGRAM_OVERHEAD+packet_cost(width, height)
+
+def row_spans(old, new, start, end):
+    """Returns [start, end] column spans in which the planes old and new
+    differ between the offsets start and end. Spans closer than one packet
+    header are merged, as resending the unchanged gap is cheaper than
+    starting a new packet."""
+    spans=[]
+    if old[start:end]==new[start:end]:
+        return spans
+    for j in range(start, end):
+        if old[j]==new[j]:
+            continue
+        if spans and j-start-spans[-1][1]<=board.PACKET_OVERHEAD:
+            spans[-1][1]=j-start
+        else:
+            spans.append([j-start, j-start])
+    return spans
+
+def row_extent(old, new, start, end):
+    """Returns the first and last column in which the planes old and new
+    differ between the offsets start and end, or None."""
+    if old[start:end]==new[start:end]:
+        return None
+    a=start
+    while old[a]==new[a]: a+=1
+    b=end-1
+    while old[b]==new[b]: b-=1
+    return (a-start, b-start)
+
+def changed_rects(old, new, width, first=0, last=None):
+    """Returns (x, y, width, height) rectangles covering all cells in which
+    the flat planes old and new differ, in the rows first to last. A span
+    is merged into a rectangle from the row above whenever the merged packet
+    is not larger than two packets."""
+    if last is None:
+        last=len(new)/width-1
+    done=[]
+    active=[] # [x0, y0, x1, y1], touching the current or previous row
+    for i in range(first, last+1):
+        for a, b in row_spans(old, new, i*width, (i+1)*width):
+            best=None
+            best_saving=-1
+            for r in active:
+                x0=min(r[0], a)
+                x1=max(r[2], b)
+                merged=packet_cost(x1-x0+1, i-r[1]+1)
+                separate=packet_cost(r[2]-r[0]+1, r[3]-r[1]+1) \
+                    +packet_cost(b-a+1, 1)
+                if separate-merged>best_saving:
+                    best=r
+                    best_saving=separate-merged
+            if best is None:
+                active.append([a, i, b, i])
+            else:
+                best[0]=min(best[0], a)
+                best[2]=max(best[2], b)
+                best[3]=i
+        done+=[r for r in active if r[3]<i]
+        active=[r for r in active if r[3]==i]
+    done+=active
+    return [(r[0], r[1], r[2]-r[0]+1, r[3]-r[1]+1) for r in done]
+
+def band_rects(old, new, width, first, last):
+    """Returns rectangles covering the changes in the rows first to last,
+    which have scrolled. After a scroll nearly every row differs in many
+    small spans; one trimmed span per row, merged into tall rectangles,
+    needs a fraction of the datagrams. Whichever of the two coverings costs
+    fewer bytes including the IP and UDP headers is returned."""
+    rects=[]
+    r=None # [x0, y0, x1, y1]
+    for i in range(first, last+1):
+        extent=row_extent(old, new, i*width, (i+1)*width)
+        if extent is None:
+            continue
+        a, b = extent
+        if r is not None and r[3]==i-1:
+            x0=min(r[0], a)
+            x1=max(r[2], b)
+            merged=datagram_cost(x1-x0+1, i-r[1]+1)
+            separate=datagram_cost(r[2]-r[0]+1, r[3]-r[1]+1) \
+                +datagram_cost(b-a+1, 1)
+            if merged<=separate:
+                r[0], r[2], r[3] = x0, x1, i
+                continue
+        r=[a, i, b, i]
+        rects.append(r)
+    rects=[(r[0], r[1], r[2]-r[0]+1, r[3]-r[1]+1) for r in rects]
+    spans=changed_rects(old, new, width, first, last)
+    if sum([datagram_cost(w, h) for x, y, w, h in spans]) \
+            <=sum([datagram_cost(w, h) for x, y, w, h in rects]):
+        return spans
+    return rects
+
+def frame_rects(old, new, width, bands=()):
+    """Like changed_rects, but falls back to a single full-frame rectangle if
+    that costs fewer bytes. bands are (first, last) row ranges that
+    scrolled since old was sent, which are covered by band_rects. Returns []
+    if nothing changed."""
+    if old==new:
+        return []
+    height=len(new)/width
+    rects=[]
+    row=0
+    for first, last in merge_bands(bands):
+        last=min(last, height-1)
+        if first>last:
+            continue
+        if row<first:
+            rects+=changed_rects(old, new, width, row, first-1)
+        rects+=band_rects(old, new, width, first, last)
+        row=last+1
+    if row<height:
+        rects+=changed_rects(old, new, width, row)
+    if sum([packet_cost(w, h) for x, y, w, h in rects]) \
+            >=packet_cost(width, height):
+        return [(0, 0, width, height)]
+    return rects
+
+def lum_planes(char, lum, previous):
+    """Returns the luminance plane to send and the one that shows. A blank
+    cell is dark whatever its luminance, so in the plane to send it keeps
+    its luminance in previous, the plane on the board, and never needs a
+    write; in the plane that shows, it is NO_LUM."""
+    target=bytearray(lum)
+    shown=bytearray(lum)
+    for m in BLANK_RE.finditer(str(char)):
+        a, b = m.span()
+        target[a:b]=previous[a:b]
+        shown[a:b]=NO_LUM_CELLS[:b-a]
+    return target, shown
+
+def uniform_lum(shown):
+    """Returns the luminance of all cells of a plane from lum_planes that
+    show, if it is one and the same, else None."""
+    levels=set(shown)
+    levels.discard(NO_LUM)
+    if len(levels)==1:
+        return levels.pop()
+    return None
+
+def merge_bands(bands):
+    """Sorts row ranges and joins the overlapping ones."""
+    merged=[]
+    for first, last in sorted(bands):
+        if merged and first<=merged[-1][1]+1:
+            merged[-1][1]=max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    return merged
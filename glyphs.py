@@ -0,0 +1,173 @@
+"""Text in pixel mode: fonts, a glyph atlas and a renderer that draws a
+Buffer into the board's bitmap, one 8x12 pixel cell per character."""
+import struct
+import board
+
+GLYPH_HEIGHT=board.CELL_PIXEL_HEIGHT # bytes, one per row of 8 pixels
+BITMAP_STRIDE=board.PIXEL_WIDTH/8 # bytes per pixel row
+
+PSF1_MAGIC="\x36\x04"
+PSF2_MAGIC="\x72\xb5\x4a\x86"
+
+# 4x4 ordered dither, dims a cell to its luminance
+BAYER=(0, 8, 2, 10, 12, 4, 14, 6, 3, 11, 1, 9, 15, 7, 13, 5)
+
+# 5x7 font for 0x20 to 0x7e, seven rows of five bits as hex per character
+BUILTIN_5X7=(
+    "00000000000000", "04040404040004", "0a0a0a00000000", "0a0a1f0a1f0a0a",
+    "040f140e051e04", "18190204081303", "0c12140815120d", "0c040800000000",
+    "02040808080402", "08040202020408", "0004150e150400", "0004041f040400",
+    "000000000c0408", "0000001f000000", "00000000000c0c", "00010204081000",
+    "0e11131519110e", "040c040404040e", "0e11010204081f", "1f02040201110e",
+    "02060a121f0202", "1f101e0101110e", "0608101e11110e", "1f010204080808",
+    "0e11110e11110e", "0e11110f01020c", "000c0c000c0c00", "000c0c000c0408",
+    "02040810080402", "00001f001f0000", "08040201020408", "0e110102040004",
+    "0e11010d15150e", "0e11111f111111", "1e11111e11111e", "0e11101010110e",
+    "1c12111111121c", "1f10101e10101f", "1f10101e101010", "0e11101711110f",
+    "1111111f111111", "0e04040404040e", "0702020202120c", "11121418141211",
+    "1010101010101f", "111b1515111111", "11111915131111", "0e11111111110e",
+    "1e11111e101010", "0e11111115120d", "1e11111e141211", "0f10100e01011e",
+    "1f040404040404", "1111111111110e", "11111111110a04", "1111111515150a",
+    "11110a040a1111", "1111110a040404", "1f01020408101f", "0e08080808080e",
+    "00100804020100", "0e02020202020e", "040a1100000000", "0000000000001f",
+    "08040200000000", "00000e010f110f", "1010161911111e", "00000e1010110e",
+    "01010d1311110f", "00000e111f100e", "0609081c080808", "000f11110f010e",
+    "10101619111111", "04000c0404040e", "0200060202120c", "10101214181412",
+    "0c04040404040e", "00001a15151111", "00001619111111", "00000e1111110e",
+    "00001e111e1010", "00000d130f0101", "00001619101010", "00000e100e011e",
+    "08081c08080906", "0000111111130d", "00001111110a04", "0000111115150a",
+    "0000110a040a11", "000011110f010e", "00001f0204081f", "02040408040402",
+    "04040404040404", "08040402040408", "00000815020000",
+)
+
+def builtin_font():
+    """Returns the built-in font as 256 glyphs of GLYPH_HEIGHT bytes. Its
+    5x7 characters sit in the upper middle of the cell, the codes it has no
+    character for are blank."""
+    glyphs=["\0"*GLYPH_HEIGHT]*256
+    for i, rows in enumerate(BUILTIN_5X7):
+        glyph=bytearray(GLYPH_HEIGHT)
+        for j in range(7):
+            glyph[2+j]=int(rows[2*j:2*j+2], 16)<<2
+        glyphs[0x20+i]=str(glyph)
+    return glyphs
+
+def load_psf(path):
+    """Returns the first 256 glyphs of a PC Screen Font, version 1 or 2, at
+    most 8 pixels wide. Taller glyphs are cropped to the cell, shorter ones
+    centred in it. Raises ValueError for other files."""
+    data=open(path, "rb").read()
+    if data[:2]==PSF1_MAGIC and len(data)>=4:
+        mode, height = struct.unpack("BB", data[2:4])
+        offset, count, size, width = 4, mode&1 and 512 or 256, height, 8
+    elif data[:4]==PSF2_MAGIC and len(data)>=32:
+        version, offset, flags, count, size, height, width = \
+            struct.unpack("<7I", data[4:32])
+    else:
+        raise ValueError("%s: not a PSF font" % path)
+    if width>8 or height==0:
+        raise ValueError("%s: glyphs of %dx%d pixels do not fit a cell"
+            % (path, width, height))
+    if len(data)<offset+count*size:
+        raise ValueError("%s: truncated" % path)
+    stride=size/height
+    top=max(0, (height-GLYPH_HEIGHT)/2)
+    pad="\0"*max(0, (GLYPH_HEIGHT-height)/2)
+    glyphs=[]
+    for i in range(min(count, 256)):
+        o=offset+i*size
+        rows="".join([data[o+r*stride] for r in
+            range(top, min(height, top+GLYPH_HEIGHT))])
+        glyphs.append((pad+rows).ljust(GLYPH_HEIGHT, "\0"))
+    return glyphs+["\0"*GLYPH_HEIGHT]*(256-len(glyphs))
+
+def lum_mask(level):
+    """Returns the GLYPH_HEIGHT bytes of the dither pattern lighting
+    level/LUM_MAX of the pixels of a cell."""
+    mask=bytearray(GLYPH_HEIGHT)
+    for y in range(GLYPH_HEIGHT):
+        for x in range(8):
+            if BAYER[(y%4)*4+x%4]*board.LUM_MAX<level*16:
+                mask[y]|=0x80>>x
+    return mask
+
+class GlyphAtlas:
+    """Cell bitmaps by character code, luminance and inverse video. Those
+    at full luminance are drawn up front, dimmed ones when first used."""
+    def __init__(self, font):
+        self.font=font
+        self.masks=[lum_mask(level) for level in range(board.LUM_MAX+1)]
+        self.cache={}
+        for code in range(256):
+            self.glyph(code)
+            self.glyph(code, inverse=True)
+
+    def glyph(self, code, lum=board.LUM_MAX, inverse=False):
+        """Returns the GLYPH_HEIGHT bytes of a cell."""
+        level=min(lum, board.LUM_MAX)
+        if lum>127: level=0 # a negative signed byte
+        key=(code, level, inverse)
+        glyph=self.cache.get(key)
+        if glyph is None:
+            rows=bytearray(self.font[code])
+            mask=self.masks[level]
+            for i in range(GLYPH_HEIGHT):
+                if inverse: rows[i]^=0xff
+                rows[i]&=mask[i]
+            glyph=self.cache[key]=str(rows)
+        return glyph
+
+class TextRenderer:
+    """Draws a Buffer into a board.PIXEL_BYTES bitmap. Only the cells that
+    changed since the last render are drawn. Without colored, every cell is
+    drawn at full luminance like in text mode. Inverse video is only used
+    for the cursor: a Buffer does not keep SGR 7 per cell."""
+    def __init__(self, atlas, colored=False, width=board.DSP_WIDTH,
+            height=board.DSP_HEIGHT):
+        self.atlas=atlas
+        self.colored=colored
+        self.width=width
+        self.height=height
+        self.bitmap=bytearray(height*GLYPH_HEIGHT*BITMAP_STRIDE)
+        self.char=None # as drawn, None before the first render
+        self.lum=None
+        self.cursor=None
+        self.cells=0 # drawn
+
+    def render(self, buffer, cursor=None, cursor_lum=board.LUM_MAX):
+        """cursor is an optional (row, col) drawn in inverse video at
+        cursor_lum, whatever the luminance of the cell, which is 0 for a
+        blank one."""
+        full=self.char is None
+        if full:
+            self.char=bytearray(len(buffer.char))
+            self.lum=bytearray(len(buffer.lum))
+        forced=[c for c in (self.cursor, cursor) if c is not None]
+        self.cursor=cursor
+        w=self.width
+        for row in range(self.height):
+            o=row*w
+            cols=[col for r, col in forced if r==row]
+            if not (full or cols) and buffer.char[o:o+w]==self.char[o:o+w] \
+                    and buffer.lum[o:o+w]==self.lum[o:o+w]:
+                continue
+            for col in range(w):
+                i=o+col
+                if full or col in cols or buffer.char[i]!=self.char[i] \
+                        or buffer.lum[i]!=self.lum[i]:
+                    if (row, col)==cursor:
+                        self.draw_cell(row, col, buffer.char[i], cursor_lum,
+                            True)
+                    else:
+                        self.draw_cell(row, col, buffer.char[i],
+                            buffer.lum[i])
+            self.char[o:o+w]=buffer.char[o:o+w]
+            self.lum[o:o+w]=buffer.lum[o:o+w]
+
+    def draw_cell(self, row, col, code, lum, inverse=False):
+        if not self.colored:
+            lum=board.LUM_MAX
+        o=row*GLYPH_HEIGHT*BITMAP_STRIDE+col
+        self.bitmap[o:o+GLYPH_HEIGHT*BITMAP_STRIDE:BITMAP_STRIDE]= \
+            self.atlas.glyph(code, lum, inverse)
+        self.cells+=1
@@ -0,0 +1,76 @@
+"""Scrollback: the rows scrolled off the top of the terminal."""
+import zlib
+import collections
+
+BLOCK_LINES=64 # rows compressed together
+ZLIB_LEVEL=1 # levels above hardly compress rows better, but slower
+SCROLLBACK_LINES=10000
+SCROLLBACK_BYTES=4*1024*1024
+
+class Scrollback:
+    """A ring of the last rows of width cells, each a character and a
+    luminance bytearray. Rows are collected into blocks of BLOCK_LINES,
+    which are stored zlib compressed. When there are more than max_lines
+    rows or the blocks take more than max_bytes, the oldest blocks are
+    dropped, so memory stays bounded however long the output runs.
+
+    Rows are numbered from 0, the oldest one kept."""
+    def __init__(self, width, max_lines=SCROLLBACK_LINES,
+            max_bytes=SCROLLBACK_BYTES):
+        self.width=width
+        self.max_lines=max_lines
+        self.max_bytes=max_bytes
+        self.blocks=collections.deque() # compressed, BLOCK_LINES rows each
+        self.size=0 # bytes in blocks
+        self.pending=bytearray(BLOCK_LINES*2*width) # rows not yet in a block
+        self.pending_lines=0
+        self.lines=0
+        self.total=0 # rows ever appended
+        self.cached=(None, None) # block index and its rows
+
+    def __len__(self):
+        return self.lines
+
+    def append(self, chars, lums):
+        """Appends a row, given as the first width bytes of chars and
+        lums."""
+        o=self.pending_lines*2*self.width
+        self.pending[o:o+self.width]=chars[:self.width]
+        self.pending[o+self.width:o+2*self.width]=lums[:self.width]
+        self.pending_lines+=1
+        self.lines+=1
+        self.total+=1
+        if self.pending_lines==BLOCK_LINES:
+            block=zlib.compress(str(self.pending), ZLIB_LEVEL)
+            self.blocks.append(block)
+            self.size+=len(block)
+            self.pending_lines=0
+        while self.blocks and (self.lines>self.max_lines
+                or self.size>self.max_bytes):
+            self.size-=len(self.blocks.popleft())
+            self.lines-=BLOCK_LINES
+            self.cached=(None, None)
+
+    def block(self, i):
+        """Returns block i, or the pending rows after the last block, as a
+        string of chars and lums row after row."""
+        if i==len(self.blocks):
+            return str(self.pending[:self.pending_lines*2*self.width])
+        if self.cached[0]!=i:
+            self.cached=(i, zlib.decompress(self.blocks[i]))
+        return self.cached[1]
+
+    def row(self, n):
+        """Returns characters and luminances of row n."""
+        if not 0<=n<self.lines:
+            raise IndexError("no row %d in the scrollback" % n)
+        data=self.block(n/BLOCK_LINES)
+        o=n%BLOCK_LINES*2*self.width
+        return data[o:o+self.width], data[o+self.width:o+2*self.width]
+
+    def clear(self):
+        self.blocks.clear()
+        self.size=0
+        self.pending_lines=0
+        self.lines=0
+        self.cached=(None, None)
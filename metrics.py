@@ -0,0 +1,222 @@
+"""Counters and timing histograms of the terminal pipeline, exported as JSON
+lines or as Prometheus text on a Unix socket."""
+import os
+import stat
+import time
+import json
+import bisect
+import socket
+import errno
+import asyncore
+
+# upper bounds of the histogram buckets in seconds
+BUCKETS=(0.0001, 0.0003, 0.001, 0.003, 0.01, 0.03, 0.1, 0.3, 1.0)
+PREFIX="chaosboard_"
+REQUEST_TIMEOUT=0.5 # seconds a scrape may take to send its request
+
+def sample_name(name, labels):
+    if not labels: return name
+    return "%s{%s}" % (name, ",".join(['%s="%s"' % (k, labels[k])
+        for k in sorted(labels)]))
+
+class Counter:
+    def __init__(self):
+        self.value=0
+
+    def inc(self, n=1):
+        self.value+=n
+
+class Histogram:
+    """Also a context manager that observes its run time; not reentrant."""
+    def __init__(self):
+        self.buckets=[0]*(len(BUCKETS)+1)
+        self.count=0
+        self.sum=0.0
+        self.start=0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(BUCKETS, value)]+=1
+        self.count+=1
+        self.sum+=value
+
+    def __enter__(self):
+        self.start=time.time()
+
+    def __exit__(self, *exc_info):
+        self.observe(time.time()-self.start)
+
+class Metrics:
+    """Modules look up their counters and histograms once and keep them,
+    so that the hot path does not build sample names."""
+    def __init__(self):
+        self.counters={}
+        self.histograms={}
+
+    def counter(self, name, **labels):
+        key=(name, sample_name(name, labels))
+        c=self.counters.get(key)
+        if c is None:
+            c=self.counters[key]=Counter()
+        return c
+
+    def histogram(self, name, **labels):
+        key=(name, sample_name(name, labels))
+        h=self.histograms.get(key)
+        if h is None:
+            h=self.histograms[key]=Histogram()
+        return h
+
+    def json_line(self):
+        data={"time": time.time(), "counters": {}, "histograms": {}}
+        for (name, sample), c in self.counters.items():
+            data["counters"][sample]=c.value
+        for (name, sample), h in self.histograms.items():
+            data["histograms"][sample]={"count": h.count, "sum": h.sum,
+                "buckets": dict(zip([str(b) for b in BUCKETS]+["+Inf"],
+                    h.buckets))}
+        return json.dumps(data, sort_keys=True)
+
+    def prometheus_text(self):
+        lines=[]
+        typed=set()
+        for (name, sample), c in sorted(self.counters.items()):
+            if name not in typed:
+                lines.append("# TYPE %s%s counter" % (PREFIX, name))
+                typed.add(name)
+            lines.append("%s%s %d" % (PREFIX, sample, c.value))
+        for (name, sample), h in sorted(self.histograms.items()):
+            if name not in typed:
+                lines.append("# TYPE %s%s histogram" % (PREFIX, name))
+                typed.add(name)
+            labels=sample[len(name):].strip("{}")
+            if labels: labels+=","
+            total=0
+            for bound, n in zip([str(b) for b in BUCKETS]+["+Inf"],
+                    h.buckets):
+                total+=n
+                lines.append('%s%s_bucket{%sle="%s"} %d'
+                    % (PREFIX, name, labels, bound, total))
+            suffix=sample[len(name):]
+            lines.append("%s%s_sum%s %f" % (PREFIX, name, suffix, h.sum))
+            lines.append("%s%s_count%s %d" % (PREFIX, name, suffix, h.count))
+        return "\n".join(lines)+"\n"
+
+class ExporterChannel(asyncore.dispatcher):
+    """Wakes an asyncore loop when a socket of an Exporter is readable."""
+    def __init__(self, exporter, sock, map, listening):
+        asyncore.dispatcher.__init__(self, sock, map)
+        self.exporter=exporter
+        self.accepting=listening
+
+    def writable(self):
+        return False
+
+    def handle_accept(self):
+        self.exporter.serve()
+
+    def handle_read(self):
+        self.exporter.serve()
+
+class Exporter:
+    """Appends a JSON line to json_path every interval seconds and serves
+    the Prometheus text to every connection on the Unix socket
+    socket_path. Call poll from the main loop, and wake it up when one of
+    its sockets is readable, or attach it to an asyncore loop. Nothing
+    blocks: the answer goes out once the request is in, or after
+    REQUEST_TIMEOUT seconds for a client that sends none."""
+    def __init__(self, metrics, json_path=None, socket_path=None,
+            interval=5):
+        self.metrics=metrics
+        self.interval=interval
+        self.next_dump=time.time()+interval
+        self.json_file=None
+        if json_path is not None:
+            self.json_file=open(json_path, "a")
+        self.sock=None
+        if socket_path is not None:
+            if os.path.lexists(socket_path):
+                if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+                    raise ValueError("%s: exists and is not a socket"
+                        % socket_path)
+                os.unlink(socket_path) # stale socket of an earlier run
+            self.sock=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(socket_path)
+            self.sock.listen(5)
+            self.sock.setblocking(0)
+        self.clients={} # connection -> [end of the request, deadline]
+        self.map=None
+        self.channels={} # socket -> ExporterChannel, see attach
+
+    def sockets(self):
+        """Returns the sockets to wait for in a select loop."""
+        if self.sock is None: return []
+        return [self.sock]+self.clients.keys()
+
+    def attach(self, map):
+        """Lets the asyncore loop of map wake up for scrapes."""
+        self.map=map
+        for sock in self.sockets():
+            self.watch(sock)
+
+    def watch(self, sock):
+        if self.map is not None:
+            self.channels[sock]=ExporterChannel(self, sock, self.map,
+                sock is self.sock)
+
+    def poll(self):
+        """Returns the seconds until it needs to be called again, or
+        None."""
+        timeout=None
+        if self.sock is not None:
+            self.serve()
+            now=time.time()
+            for end, deadline in self.clients.values():
+                if timeout is None or deadline-now<timeout:
+                    timeout=max(0, deadline-now)
+        if self.json_file is None: return timeout
+        now=time.time()
+        if now>=self.next_dump:
+            self.json_file.write(self.metrics.json_line()+"\n")
+            self.json_file.flush()
+            self.next_dump=now+self.interval
+        if timeout is None: return max(0, self.next_dump-now)
+        return min(timeout, max(0, self.next_dump-now))
+
+    def serve(self):
+        """Accepts the waiting connections and answers those whose request
+        is in, e.g. an HTTP request by curl, or that waited long enough."""
+        now=time.time()
+        while True:
+            try:
+                conn, address = self.sock.accept()
+            except socket.error, err:
+                if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK): break
+                raise
+            conn.setblocking(0)
+            self.clients[conn]=["", now+REQUEST_TIMEOUT]
+            self.watch(conn)
+        for conn, client in self.clients.items():
+            try:
+                data=conn.recv(4096)
+                client[0]=(client[0]+data)[-4:]
+                done=data=="" or client[0]=="\r\n\r\n"
+            except socket.error, err:
+                done=err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK)
+            if done or now>=client[1]:
+                self.answer(conn)
+
+    def answer(self, conn):
+        body=self.metrics.prometheus_text()
+        try:
+            conn.sendall("HTTP/1.0 200 OK\r\n"
+                "Content-Type: text/plain; version=0.0.4\r\n"
+                "Content-Length: %d\r\n\r\n%s" % (len(body), body))
+        except socket.error:
+            pass
+        del self.clients[conn]
+        if conn in self.channels:
+            self.channels.pop(conn).del_channel()
+        conn.close()
+
+# shared by all modules of one process
+registry=Metrics()
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+"""Streams an Xvfb framebuffer to the board in pixel mode, the job of
+x/xdisp.
+
+The XWD file written by Xvfb -fbdir is memory-mapped and read in place.
+Every frame is greyscaled and thresholded into a one bit per pixel bitmap,
+and only the parts of the bitmap that changed are sent. xdisp sharpens
+and dithers the grey image instead, so its bitmaps differ."""
+import os, sys
+import mmap
+import time
+import getopt
+import numpy
+import board
+import transport
+import pixelstream
+
+THRESHOLD=127 # LEDWAND_BIAS, grey values above are lit
+
+class XwdSource:
+    """The pixels of an XWD file of board.PIXEL_WIDTH x board.PIXEL_HEIGHT
+    in 32 bit, as written by Xvfb -screen 0 448x240x24."""
+    def __init__(self, path):
+        f=open(path, "rb")
+        size=os.fstat(f.fileno()).st_size
+        length=board.PIXEL_WIDTH*board.PIXEL_HEIGHT*4
+        if size<length:
+            raise ValueError("%s: illegal input file size %d" % (path, size))
+        self.map=mmap.mmap(f.fileno(), size, mmap.MAP_SHARED, mmap.PROT_READ)
+        f.close()
+        # the pixels are at the end of the file, after header and colormap
+        self.frame=numpy.frombuffer(self.map, numpy.uint32,
+            board.PIXEL_WIDTH*board.PIXEL_HEIGHT, size-length).reshape(
+            board.PIXEL_HEIGHT, board.PIXEL_WIDTH)
+
+def to_bitmap(frame, threshold=THRESHOLD):
+    """Returns the PIXEL_BYTES bitmap of a frame of 32 bit pixels, lit where
+    the grey value is above threshold. The grey value is 0.3 of the sum of
+    the colour channels, truncated to an integer. It is not sharpened or
+    dithered, unlike in ledwand_draw_image."""
+    total=(frame&0xff)+((frame>>8)&0xff)+((frame>>16)&0xff)
+    return numpy.packbits(total*3>=(threshold+1)*10).tobytes()
+
+def usage():
+    print "Usage: pixel.py [-r|--remote host] [-p|--port] [-f|--fps]" \
+        " [-y|--dry-run] [-R|--reliable] [-k|--keyframe SECONDS] XWD_FILE"
+    print
+    print "Shows XWD_FILE, the framebuffer of Xvfb -fbdir, on the board. See"
+    print "x/run.sh. host may be unix:PATH for a simulator on a Unix socket."
+    print "Unless --reliable, the whole bitmap is sent again every %g" % (
+        pixelstream.KEYFRAME_INTERVAL)
+    print "seconds, or every --keyframe seconds; 0 turns it off."
+
+def main():
+    port=board.NET_PORT
+    host=board.NET_HOST
+    dry_run=False
+    reliable=False
+    fps=30
+    keyframe_interval=None
+    try:
+        opts, args=getopt.getopt(sys.argv[1:], "hr:p:f:yRk:",
+            ("help", "remote=", "port=", "fps=", "dry-run", "reliable",
+            "keyframe="))
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(1)
+    for o, a in opts:
+        if o in ("-h", "--help"): usage(); return
+        if o in ("-r", "--remote"): host=a
+        if o in ("-p", "--port"): port=int(a)
+        if o in ("-f", "--fps"): fps=float(a)
+        if o in ("-y", "--dry-run"): dry_run=True
+        if o in ("-R", "--reliable"): reliable=True
+        if o in ("-k", "--keyframe"): keyframe_interval=float(a)
+    if len(args)!=1:
+        usage()
+        sys.exit(1)
+    try:
+        source=XwdSource(args[0])
+    except (IOError, ValueError), err:
+        print str(err)
+        sys.exit(1)
+    bd=board.Board(dry_run=dry_run, reliable=reliable,
+        transport=transport.open_transport(host, port), pacer=board.Pacer())
+    stream=pixelstream.PixelStream(bd, keyframe_interval)
+    next_frame=time.time()
+    while True:
+        for lost in bd.take_lost():
+            stream.invalidate(*lost)
+        stream.send(to_bitmap(source.frame))
+        next_frame=max(next_frame+1.0/fps, time.time())
+        while True: # the pacer sends the parts meanwhile
+            timeout=bd.poll()
+            delay=next_frame-time.time()
+            if delay<=0: break
+            if timeout is not None:
+                delay=min(delay, timeout)
+            time.sleep(delay)
+
+if __name__=="__main__": main()
@@ -0,0 +1,81 @@
+"""Pacing of pixel mode bitmaps to the board."""
+import time
+import board
+
+GAP_MAX=0.02 # seconds between two parts to a board that keeps losing them
+KEYFRAME_INTERVAL=2.0 # seconds, all parts are resent this often
+
+class PixelStream:
+    """Sends bitmaps part by part, skipping the parts the board already
+    shows. The parts go through the board.Pacer of each target, which
+    spaces them and lets a newer part replace a queued one, so sending
+    never blocks. The packet rate of a target's pacer halves whenever the
+    target loses a part, which needs reliable mode to be noticed, down to
+    one part per GAP_MAX, and grows back to where it was with every bitmap
+    sent without losses. A target without a pacer gets the parts at once.
+
+    Every keyframe_interval seconds all parts are sent again, to repair
+    losses nobody noticed; by default only if a target is not reliable.
+    0 turns it off."""
+    def __init__(self, bd, keyframe_interval=None):
+        self.board=bd
+        if keyframe_interval is None:
+            keyframe_interval=0
+            for target in bd.targets:
+                if not target.reliable():
+                    keyframe_interval=KEYFRAME_INTERVAL
+        self.keyframe_interval=keyframe_interval
+        self.sent=[None]*board.PIXEL_PARTS # as the board shows them
+        self.rates={} # target -> packet rate of its pacer before losses
+        for target in bd.targets:
+            if target.pacer is not None and target.pacer.packet_rate:
+                self.rates[target]=target.pacer.packet_rate
+        self.lossy=set() # targets that lost parts since the last send
+        self.next_keyframe=0
+        self.parts=0 # sent
+        self.skipped=0
+
+    def invalidate(self, command, x, y, width, height):
+        """Forgets a part whose write was lost, see Board.take_lost, so that
+        the next send repeats it."""
+        if command!=board.CMD_LED_DRAW: return
+        self.sent[x/board.PIXEL_PART_SIZE]=None
+        self.lossy.add(self.board)
+
+    def resend(self, target, lost):
+        """Sends target the parts of its lost writes as the board shows
+        them, see Board.take_lost. Only the pacer of target slows down; a
+        target of a board.Fanout is repaired on its own and does not hold
+        up the others."""
+        offsets=set([x for command, x, y, width, height in lost
+            if command==board.CMD_LED_DRAW])
+        for offset in sorted(offsets):
+            self.lossy.add(target)
+            part=self.sent[offset/board.PIXEL_PART_SIZE]
+            if part is not None: # else the next send has it
+                target.draw_part(offset, part)
+
+    def adapt(self):
+        for target, rate in self.rates.items():
+            pacer=target.pacer
+            if target in self.lossy or self.board in self.lossy:
+                pacer.packet_rate=max(pacer.packet_rate/2.0, 1/GAP_MAX)
+            else:
+                pacer.packet_rate=min(pacer.packet_rate*1.1, rate)
+        self.lossy.clear()
+
+    def send(self, bitmap):
+        self.adapt()
+        now=time.time()
+        if self.keyframe_interval and now>=self.next_keyframe:
+            self.sent=[None]*board.PIXEL_PARTS
+            self.next_keyframe=now+self.keyframe_interval
+        for i in range(board.PIXEL_PARTS):
+            offset=i*board.PIXEL_PART_SIZE
+            part=str(bitmap[offset:offset+board.PIXEL_PART_SIZE])
+            if part==self.sent[i]:
+                self.skipped+=1
+                continue
+            self.board.draw_part(offset, part)
+            self.sent[i]=part
+            self.parts+=1
@@ -0,0 +1,167 @@
+"""Recordings of terminal sessions: the PTY output and the board packets,
+timestamped, with keyframes of the wall for seeking.
+
+A recording starts with FILE_HEADER, followed by records of RECORD_HEADER
+and a payload of its length. The time of a record is in milliseconds since
+the start of the recording. Records are only ever appended, so a recording
+is readable while it is written, and a record cut short by a crash ends
+it. A keyframe is KEYFRAME_HEADER, the character and luminance planes and,
+in pixel mode, the bitmap, as the wall shows them at that time."""
+import os
+import mmap
+import time
+import struct
+import bisect
+import board
+import simulator
+
+MAGIC="LWRC"
+VERSION=1
+FILE_HEADER=struct.Struct("!4sBHHd") # magic, version, width, height, start
+RECORD_HEADER=struct.Struct("!BII") # kind, milliseconds, payload length
+KEYFRAME_HEADER=struct.Struct("!Bb") # flags, luminance of CMD_WRITE_STD
+
+RECORD_PTY=1
+RECORD_PACKET=2
+RECORD_KEYFRAME=3
+RECORD_NAMES={RECORD_PTY: "pty", RECORD_PACKET: "packet",
+    RECORD_KEYFRAME: "keyframe"}
+
+KEY_PIXELS=1 # the keyframe includes the pixel mode bitmap
+
+KEYFRAME_INTERVAL=10 # seconds
+
+class Recorder:
+    """Writes a recording to path. The packets are also applied to a quiet
+    simulator, whose framebuffer goes into a keyframe every
+    keyframe_interval seconds of output."""
+    def __init__(self, path, keyframe_interval=KEYFRAME_INTERVAL):
+        self.keyframe_interval=keyframe_interval
+        self.shadow=simulator.Simulator(quiet=True)
+        self.pixel_mode=False # seen a CMD_LED_DRAW
+        self.start=time.time()
+        self.file=open(path, "wb")
+        self.file.write(FILE_HEADER.pack(MAGIC, VERSION, self.shadow.width,
+            self.shadow.height, self.start))
+        self.keyframe(self.start) # the empty wall
+
+    def write(self, kind, data, now):
+        self.file.write(RECORD_HEADER.pack(kind,
+            int((now-self.start)*1000), len(data)))
+        self.file.write(data)
+
+    def pty(self, data):
+        self.write(RECORD_PTY, data, time.time())
+
+    def packet(self, message):
+        """Records a datagram on its way to the board."""
+        now=time.time()
+        self.write(RECORD_PACKET, message, now)
+        if isinstance(message, memoryview):
+            message=message.tobytes()
+        self.shadow.process(message)
+        if message[:2]==struct.pack("!H", board.CMD_LED_DRAW):
+            self.pixel_mode=True
+        if now>=self.next_keyframe:
+            self.keyframe(now)
+
+    def keyframe(self, now):
+        flags=0
+        data=[str(self.shadow.char), str(self.shadow.lum)]
+        if self.pixel_mode:
+            flags|=KEY_PIXELS
+            data.append(str(self.shadow.pixels))
+        self.write(RECORD_KEYFRAME,
+            KEYFRAME_HEADER.pack(flags, self.shadow.std_lum)+"".join(data),
+            now)
+        self.file.flush()
+        self.next_keyframe=now+self.keyframe_interval
+
+    def close(self):
+        self.file.close()
+
+class Keyframe:
+    """The wall at the time of a keyframe; pixels is None in text mode."""
+    def __init__(self, data, width, height):
+        flags, self.std_lum = KEYFRAME_HEADER.unpack_from(data)
+        self.width=width
+        cells=width*height
+        o=KEYFRAME_HEADER.size
+        self.char=data[o:o+cells]
+        self.lum=data[o+cells:o+2*cells]
+        self.pixels=None
+        if flags&KEY_PIXELS:
+            self.pixels=data[o+2*cells:o+2*cells+board.PIXEL_BYTES]
+
+    def send(self, bd):
+        """Puts the keyframe on the wall."""
+        bd.display_chars(self.char, width=self.width)
+        bd.display_luminance(self.lum, width=self.width)
+        bd.send(board.CMD_WRITE_LUM_STD, data=struct.pack("b", self.std_lum))
+        if self.pixels is not None:
+            bd.draw_bitmap(self.pixels)
+            bd.refresh()
+
+def is_recording(path):
+    f=open(path, "rb")
+    magic=f.read(len(MAGIC))
+    f.close()
+    return magic==MAGIC
+
+class Recording:
+    """A recording, memory-mapped. Opening it reads the record headers once
+    to find the keyframes."""
+    def __init__(self, path):
+        f=open(path, "rb")
+        size=os.fstat(f.fileno()).st_size
+        if size<FILE_HEADER.size:
+            raise ValueError("%s: not a recording" % path)
+        self.map=mmap.mmap(f.fileno(), size, mmap.MAP_SHARED, mmap.PROT_READ)
+        f.close()
+        magic, version, self.width, self.height, self.start = \
+            FILE_HEADER.unpack_from(self.map)
+        if magic!=MAGIC or version!=VERSION:
+            raise ValueError("%s: not a recording" % path)
+        self.keyframe_times=[]
+        self.keyframe_offsets=[]
+        self.counts={} # kind -> records
+        self.bytes={} # kind -> payload bytes
+        self.duration=0
+        for offset, kind, t, length in self.headers():
+            if kind==RECORD_KEYFRAME:
+                self.keyframe_times.append(t)
+                self.keyframe_offsets.append(offset)
+            self.counts[kind]=self.counts.get(kind, 0)+1
+            self.bytes[kind]=self.bytes.get(kind, 0)+length
+            self.duration=t
+
+    def headers(self, offset=FILE_HEADER.size):
+        """Yields offset, kind, time in seconds and payload length of the
+        records from offset on."""
+        size=len(self.map)
+        while offset+RECORD_HEADER.size<=size:
+            kind, ms, length = RECORD_HEADER.unpack_from(self.map, offset)
+            end=offset+RECORD_HEADER.size+length
+            if end>size: return # cut short
+            yield offset, kind, ms/1000.0, length
+            offset=end
+
+    def records(self, offset=FILE_HEADER.size):
+        """Yields kind, time in seconds and payload of the records from
+        offset on."""
+        for offset, kind, t, length in self.headers(offset):
+            o=offset+RECORD_HEADER.size
+            yield kind, t, self.map[o:o+length]
+
+    def seek(self, t):
+        """Returns the offset of the last keyframe at or before t seconds,
+        where playback from t starts."""
+        i=bisect.bisect_right(self.keyframe_times, t)
+        return self.keyframe_offsets[max(0, i-1)]
+
+    def keyframe(self, data):
+        return Keyframe(data, self.width, self.height)
+
+    def pty_chunks(self):
+        """Returns the PTY output, one string per read."""
+        return [data for kind, t, data in self.records() if kind==RECORD_PTY]
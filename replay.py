@@ -0,0 +1,131 @@
+#!/usr/bin/python
+"""Plays a recording of terminal.py --record back to the board or a
+simulator, at its own pace, faster or as fast as possible.
+
+By default the recorded packets are sent as they are. Playback from the
+middle starts at the keyframe before, which is sent first, and runs
+through the packets up to the start without waiting. With --terminal the
+recorded PTY output is rendered anew instead, by the terminal of this
+tree; it is parsed from the beginning, but frames are only sent from the
+start on."""
+import sys
+import time
+import getopt
+import board
+import transport
+import terminal
+import scheduler
+import recording
+
+class Clock:
+    """Maps recording time to wall time. speed 0 is as fast as possible."""
+    def __init__(self, speed, start):
+        self.speed=speed
+        self.start=start
+        self.began=time.time()
+
+    def wait(self, t):
+        if not self.speed or t<self.start: return
+        delay=self.began+(t-self.start)/self.speed-time.time()
+        if delay>0:
+            time.sleep(delay)
+
+def play_packets(rec, bd, clock):
+    offset=rec.seek(clock.start)
+    first=True
+    for kind, t, data in rec.records(offset):
+        if kind==recording.RECORD_KEYFRAME:
+            if first:
+                rec.keyframe(data).send(bd)
+            first=False
+        elif kind==recording.RECORD_PACKET:
+            clock.wait(t)
+            bd.transmit(data)
+
+def play_terminal(rec, bd, clock, colored=False, pixel=False):
+    t=terminal.Terminal(rec.width, rec.height, spawn=False)
+    t.colored=colored
+    t.board=bd
+    t.scheduler=scheduler.FrameScheduler()
+    if pixel:
+        t.use_pixels()
+    bd.clear()
+    bd.set_luminance(7)
+    skipped=False
+    for kind, at, data in rec.records():
+        if kind!=recording.RECORD_PTY: continue
+        t.output_received(data)
+        if at<clock.start:
+            skipped=True
+            continue
+        if skipped: # the first frame is a full one
+            for command in (board.CMD_WRITE_RAW, board.CMD_WRITE_LUM_RAW):
+                t.transmitted_display.invalidate(command, 0, 0, t.width,
+                    t.height)
+            skipped=False
+        clock.wait(at)
+        t.delta_transmit()
+
+def info(rec):
+    print "duration  %.3f s" % rec.duration
+    for kind, name in sorted(recording.RECORD_NAMES.items()):
+        print "%-9s %d records, %d bytes" % (name, rec.counts.get(kind, 0),
+            rec.bytes.get(kind, 0))
+
+def usage():
+    print "Usage: replay.py [host] [-p|--port] [-s|--speed N] [-S|--seek" \
+        " SECONDS] [-t|--terminal] [-c|--colored] [-P|--pixel] [-i|--info]" \
+        " FILE"
+    print
+    print "host may be unix:PATH for a simulator on a Unix socket. --speed 0"
+    print "plays as fast as possible. --terminal renders the PTY output"
+    print "again, in color with --colored and in pixel mode with --pixel."
+    print "--info prints what the recording holds."
+
+def main():
+    port=board.NET_PORT
+    host=board.NET_HOST
+    speed=1.0
+    start=0
+    render=False
+    colored=False
+    pixel=False
+    show_info=False
+    try:
+        opts, args=getopt.gnu_getopt(sys.argv[1:], "hp:s:S:tcPi",
+            ("help", "port=", "speed=", "seek=", "terminal", "colored",
+            "pixel", "info"))
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(1)
+    for o, a in opts:
+        if o in ("-h", "--help"): usage(); return
+        if o in ("-p", "--port"): port=int(a)
+        if o in ("-s", "--speed"): speed=float(a)
+        if o in ("-S", "--seek"): start=float(a)
+        if o in ("-t", "--terminal"): render=True
+        if o in ("-c", "--colored"): colored=True
+        if o in ("-P", "--pixel"): pixel=True
+        if o in ("-i", "--info"): show_info=True
+    if len(args)==2:
+        host=args.pop(0)
+    if len(args)!=1:
+        usage()
+        sys.exit(1)
+    try:
+        rec=recording.Recording(args[0])
+    except (IOError, ValueError), err:
+        print str(err)
+        sys.exit(1)
+    if show_info:
+        info(rec)
+        return
+    bd=board.Board(transport=transport.open_transport(host, port))
+    clock=Clock(speed, start)
+    if render:
+        play_terminal(rec, bd, clock, colored, pixel)
+    else:
+        play_packets(rec, bd, clock)
+
+if __name__=="__main__": main()
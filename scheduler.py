@@ -0,0 +1,45 @@
+"""Frame coalescing for the board output."""
+import time
+import metrics
+
+class FrameScheduler:
+    """Decides when a frame goes out. Changes only mark the scheduler dirty;
+    a frame is due at most max_fps times per second and only while dirty, so
+    bursts of output collapse into the latest state and an idle terminal
+    sends nothing. output names the frames in the metrics."""
+    def __init__(self, max_fps=30, output="board"):
+        self.max_fps=max_fps
+        self.frames_total=metrics.registry.counter("frames_total",
+            output=output)
+        self.coalesced_total=metrics.registry.counter(
+            "frames_coalesced_total", output=output)
+        self.dirty=False
+        self.last_frame=0
+        self.frames=0
+        self.coalesced=0 # updates that did not get a frame of their own
+
+    def mark_dirty(self):
+        if self.dirty:
+            self.coalesced+=1
+            self.coalesced_total.inc()
+        self.dirty=True
+
+    def timeout(self, now=None):
+        """Seconds until the next frame is due, or None if nothing is
+        pending."""
+        if not self.dirty:
+            return None
+        if now is None:
+            now=time.time()
+        return max(0, self.last_frame+1.0/self.max_fps-now)
+
+    def due(self, now=None):
+        return self.timeout(now)==0
+
+    def frame_sent(self, now=None):
+        if now is None:
+            now=time.time()
+        self.dirty=False
+        self.last_frame=now
+        self.frames+=1
+        self.frames_total.inc()
@@ -0,0 +1,217 @@
+#!/usr/bin/python
+"""Runs several PTY sessions side by side on one board. All sessions are
+composed into one wall buffer, which goes through a single delta encoder and
+frame scheduler."""
+import os, sys
+import re
+import select
+import time
+import getopt
+import termios
+import tty
+import board
+import transport
+import terminal
+import scheduler
+
+FOCUS_KEY="\x1d" # ^] moves keyboard input to the next session
+GEOMETRY_RE=re.compile(r"^(\d+)x(\d+)\+(\d+)\+(\d+):(.*)$")
+
+class Session:
+    """A Terminal shown in a region of the wall."""
+    def __init__(self, x, y, width, height, command=None):
+        if x+width>board.DSP_WIDTH or y+height>board.DSP_HEIGHT:
+            raise ValueError("region %dx%d+%d+%d exceeds the board"
+                % (width, height, x, y))
+        self.x=x
+        self.y=y
+        self.terminal=terminal.Terminal(width, height, command)
+        self.alive=True
+        self.dirty=True
+
+    def cursor_overlay(self):
+        """Returns the cursor overlay in wall coordinates, or None."""
+        overlay=self.terminal.cursor_overlay()
+        if overlay is None: return None
+        row, col, cell = overlay
+        if not (0<=row<self.terminal.height and 0<=col<self.terminal.width):
+            return None
+        return (self.y+row, self.x+col, cell)
+
+class Server:
+    def __init__(self, sessions, colored=False, fps=30):
+        self.sessions=sessions
+        self.colored=colored
+        self.focus=0
+        self.wall=terminal.TermBuffer()
+        self.transmitted=terminal.TermBuffer()
+        self.scheduler=scheduler.FrameScheduler(fps)
+        self.cursor_blink_interval=0.5
+
+    def connect(self, host, port, dry_run=False, reliable=False):
+        self.board=board.Board(dry_run=dry_run, reliable=reliable,
+            transport=transport.open_transport(host, port))
+
+    def compose(self):
+        for s in self.sessions:
+            if not s.dirty: continue
+            self.wall.blit(s.terminal.display, s.x, s.y)
+            s.dirty=False
+
+    def delta_transmit(self):
+        self.compose()
+        self.wall.delta_transmit(self.board, self.transmitted, self.colored,
+            self.sessions[self.focus].cursor_overlay())
+
+    def input_received(self, data):
+        """Forwards keyboard input to the focused session."""
+        while FOCUS_KEY in data:
+            before, data = data.split(FOCUS_KEY, 1)
+            self.write_focused(before)
+            self.focus=(self.focus+1)%len(self.sessions)
+            self.scheduler.mark_dirty()
+        self.write_focused(data)
+
+    def write_focused(self, data):
+        s=self.sessions[self.focus]
+        if data and s.alive:
+            os.write(s.terminal.master, data)
+
+    def output_received(self, s):
+        try:
+            data=os.read(s.terminal.master, terminal.READ_SIZE)
+        except OSError:
+            data="" # EIO, child has exited
+        if data=="":
+            s.alive=False
+            return
+        s.terminal.char_processor(data)
+        s.terminal.cursor_blink_state=True
+        s.dirty=True
+        self.scheduler.mark_dirty()
+
+    def run(self):
+        self.board.clear()
+        self.board.set_luminance(7)
+        next_blink=time.time()
+        while [s for s in self.sessions if s.alive]:
+            board_timeout=self.board.poll()
+            for lost in self.board.take_lost():
+                self.transmitted.invalidate(*lost)
+                self.scheduler.mark_dirty()
+            now=time.time()
+            timeout=max(0, next_blink-now)
+            for t in (self.scheduler.timeout(now), board_timeout):
+                if t is not None:
+                    timeout=min(timeout, t)
+            fds=dict([(s.terminal.master, s) for s in self.sessions
+                if s.alive])
+            if os.isatty(0): fds[0]=None
+            if self.board.window is not None \
+                    and self.board.sock is not None:
+                fds[self.board.sock.fileno()]=None # wake up for replies
+            try:
+                rl=select.select(fds.keys(), [], [], timeout)[0]
+            except select.error: continue
+            for fd in rl:
+                if fd==0:
+                    self.input_received(os.read(0, terminal.READ_SIZE))
+                elif fds[fd] is not None:
+                    self.output_received(fds[fd])
+
+            now=time.time()
+            if now>=next_blink: # blinking cursor of the focused session
+                next_blink=now+self.cursor_blink_interval
+                t=self.sessions[self.focus].terminal
+                t.cursor_blink_state=not t.cursor_blink_state
+                if t.cursor_visible:
+                    self.scheduler.mark_dirty()
+
+            if self.scheduler.due(now):
+                self.delta_transmit()
+                self.scheduler.frame_sent()
+        self.delta_transmit()
+
+def tile(commands, layout):
+    """Splits the board evenly into one region per command, stacked in rows
+    or placed side by side in columns. Returns Sessions."""
+    sessions=[]
+    n=len(commands)
+    for i in range(n):
+        if layout=="columns":
+            x=i*board.DSP_WIDTH/n
+            width=(i+1)*board.DSP_WIDTH/n-x
+            y, height = 0, board.DSP_HEIGHT
+        else:
+            y=i*board.DSP_HEIGHT/n
+            height=(i+1)*board.DSP_HEIGHT/n-y
+            x, width = 0, board.DSP_WIDTH
+        sessions.append(Session(x, y, width, height, commands[i]))
+    return sessions
+
+def usage():
+    print "Usage: server.py [-r|--remote host] [-p|--port] [-c|--colored]" \
+        " [-f|--fps] [-y|--dry-run] [-R|--reliable]" \
+        " [-l|--layout rows|columns]" \
+        " [WxH+X+Y:]COMMAND..."
+    print
+    print "Runs every COMMAND in its own region of the board, either tiled"
+    print "by layout or at the given geometry. ^] switches the keyboard focus."
+    print "host may be unix:PATH for a simulator on a Unix socket."
+
+def main():
+    port=board.NET_PORT
+    host=board.NET_HOST
+    dry_run=False
+    colored=False
+    fps=30
+    layout="rows"
+    reliable=False
+    try:
+        opts, args=getopt.getopt(sys.argv[1:],
+            "hcp:r:yf:l:R", ("help", "colored", "port=", "remote=",
+            "dry-run", "fps=", "layout=", "reliable"))
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(1)
+    for o, a in opts:
+        if o in ("-h", "--help"): usage(); return
+        if o in ("-c", "--colored"): colored=True
+        if o in ("-p", "--port"): port=int(a)
+        if o in ("-r", "--remote"): host=a
+        if o in ("-y", "--dry-run"): dry_run=True
+        if o in ("-f", "--fps"): fps=float(a)
+        if o in ("-l", "--layout"): layout=a
+        if o in ("-R", "--reliable"): reliable=True
+    if len(args)==0 or layout not in ("rows", "columns"):
+        usage()
+        sys.exit(1)
+    geometries=[GEOMETRY_RE.match(a) for a in args]
+    if None in geometries and geometries.count(None)<len(geometries):
+        print "Either all or no commands need a geometry."
+        sys.exit(1)
+    try:
+        if None in geometries:
+            sessions=tile(args, layout)
+        else:
+            sessions=[Session(int(m.group(3)), int(m.group(4)),
+                int(m.group(1)), int(m.group(2)), m.group(5))
+                for m in geometries]
+    except ValueError, err:
+        print str(err)
+        sys.exit(1)
+    server=Server(sessions, colored, fps)
+    server.connect(host, port, dry_run, reliable)
+    attr=None
+    if os.isatty(0):
+        attr=termios.tcgetattr(0)
+        tty.setraw(0)
+    try:
+        server.run()
+    finally:
+        if attr is not None:
+            termios.tcsetattr(0, termios.TCSADRAIN, attr)
+        server.board.clear()
+
+if __name__=="__main__": main()
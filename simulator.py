@@ -1,93 +1,305 @@
 #!/usr/bin/python
 import struct
 import socket
+import select
+import time
+import errno
+import os, sys
+import stat
+import getopt
+import json
 import board
 
+# commands addressing a rectangle of cells
+RECT_COMMANDS=(board.CMD_WRITE_RAW, board.CMD_WRITE_LUM_RAW,
+    board.CMD_READ_RAW, board.CMD_READ_LUM_RAW)
+
 class Simulator():
-    def __init__(self, port=board.NET_PORT):
-        self.sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
-        self.host = ("", port)
-        self.clear()
-        self.print_display()
+    def __init__(self, port=board.NET_PORT, path=None, quiet=False, fps=25,
+            record=None):
+        """Listens on UDP port, or on the Unix socket path if given. A quiet
+        (headless) simulator does not print the display, otherwise it is
+        redrawn at most fps times per second. With record, every frame is
+        appended to that file as a JSON line, see snapshot."""
+        self.quiet=quiet
+        self.fps=fps
+        self.record=None
+        if record is not None:
+            self.record=open(record, "a")
+        if path is None:
+            self.sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+            self.host = ("", port)
+        else:
+            self.sock = socket.socket(socket.AF_UNIX,socket.SOCK_DGRAM)
+            self.host = path
+        self.width=board.DSP_WIDTH
+        self.height=board.DSP_HEIGHT
+        self.char=bytearray(" "*(self.width*self.height))
+        self.lum=bytearray(self.width*self.height)
+        self.pixels=bytearray(board.PIXEL_BYTES) # bitmap of pixel mode
+        self.std_lum=board.LUM_MAX # of CMD_WRITE_STD, set by CMD_WRITE_LUM_STD
+        self.dirty=True
+        self.shown=None # rows as printed, None before the first draw
+        self.changed=True # since the last snapshot
+        self.frames=0
+        self.packets={} # command name -> count
+        self.bytes=0
+        self.invalid={} # reason -> count
 
     def print_display(self):
-        print "%c[0;0H" % 27
-        border="+"
-        for i in range(board.DSP_WIDTH):
-            border+="-"
-        border+="+"
-        print border
-        for r in self.display:
-            line="|"
-            for c in r:
-                if c[1]<1:
-                    line+=" "
-                    continue
-                elif c[1]<4:
-                    color=4
-                elif c[1]<12:
-                    color=3
-                else:
-                    color=7
-                line+=("%c[3%sm" % (27, str(color))) + c[0]
-            line+="%c[37m|" % 27
-            print line
-        print border
+        """Prints the rows that changed since the last call, in one
+        write."""
+        out=[]
+        if self.shown is None:
+            border="+"+"-"*self.width+"+"
+            out.append("%c[2J%c[1;1H%s%c[%d;1H%s" % (27, 27, border,
+                27, self.height+2, border))
+            self.shown=[None]*self.height
+        for i in range(self.height):
+            o=i*self.width
+            row=(self.char[o:o+self.width], self.lum[o:o+self.width])
+            if row==self.shown[i]:
+                continue
+            self.shown[i]=row
+            out.append("%c[%d;1H|%s%c[37m|" % (27, i+2, self.ansi_row(*row),
+                27))
+        out.append("%c[%d;1H" % (27, self.height+3))
+        sys.stdout.write("".join(out))
+        sys.stdout.flush()
+        self.dirty=False
+
+    def ansi_row(self, chars, lums):
+        line=[]
+        color=None
+        for j in range(self.width):
+            lum=lums[j]
+            if lum<1 or lum>127: # luminance is a signed byte
+                line.append(" ")
+                continue
+            elif lum<4:
+                c=4
+            elif lum<12:
+                c=3
+            else:
+                c=7
+            if c!=color:
+                line.append("%c[3%dm" % (27, c))
+                color=c
+            line.append(chr(chars[j]))
+        return "".join(line)
+
+    def rows(self, plane=None):
+        """Returns the rows of plane, by default the characters, as strings
+        for assertions."""
+        if plane is None:
+            plane=self.char
+        return [str(plane[o:o+self.width])
+            for o in range(0, len(plane), self.width)]
+
+    def framebuffer(self):
+        """Returns the characters and luminances as two strings."""
+        return str(self.char), str(self.lum)
+
+    def snapshot(self):
+        """Returns the display and the packet statistics as a dictionary and
+        appends it to the record file, if any. The lum rows are hex."""
+        self.frames+=1
+        self.changed=False
+        frame={"frame": self.frames, "time": time.time(),
+            "chars": self.rows(),
+            "lum": [r.encode("hex") for r in self.rows(self.lum)],
+            "packets": self.packets, "bytes": self.bytes,
+            "invalid": self.invalid}
+        if self.record is not None:
+            self.record.write(json.dumps(frame, sort_keys=True)+"\n")
+            self.record.flush()
+        return frame
 
     def clear(self):
-        self.display = []
-        for i in range(board.DSP_HEIGHT):
-            l=[]
-            for j in range(board.DSP_WIDTH):
-                l.append([" ", 0])
-            self.display.append(l)
+        self.char[:]=" "*len(self.char)
+        self.lum[:]=bytearray(len(self.lum))
+        self.pixels[:]=bytearray(len(self.pixels))
+        self.std_lum=board.LUM_MAX
 
     def intensity(self, lum):
-        for r in self.display:
-            for c in r:
-                c[1]=lum
+        self.lum[:]=chr(lum&0xff)*len(self.lum)
+
+    def write_rect(self, plane, x, y, width, height, data):
+        for i in range(height):
+            o=(y+i)*self.width+x
+            plane[o:o+width]=data[i*width:(i+1)*width]
+
+    def read_rect(self, plane, x, y, width, height):
+        return "".join([str(plane[o:o+width]) for o in
+            range(y*self.width+x, (y+height)*self.width, self.width)])
 
     def display_chars(self, x, y, width, height, data):
-        i=0
-        for c in data:
-            cur_x = x+i%width
-            cur_y = y+i/width
-            self.display[cur_y][cur_x][0]=c
-            i=i+1
+        self.write_rect(self.char, x, y, width, height, data)
 
     def display_luminance(self, x, y, width, height, data):
-        i=0
-        for c in data:
-            cur_x = x+i%width
-            cur_y = y+i/width
-            self.display[cur_y][cur_x][1]=struct.unpack("b", c)[0]
-            i=i+1
+        self.write_rect(self.lum, x, y, width, height, data)
 
-    def receive(self):
-        message, client = self.sock.recvfrom(2048)
-        command, x, y, width, height = struct.unpack("HHHHH", message[0:10]) 
+    def write_std(self, x, y, text):
+        """Writes text from x, y on in the standard luminance, wrapping at
+        the end of a row and clipped at the end of the display."""
+        o=y*self.width+x
+        text=text[:len(self.char)-o]
+        self.char[o:o+len(text)]=text
+        self.lum[o:o+len(text)]=chr(self.std_lum&0xff)*len(text)
+
+    def check(self, command, x, y, width, height, data, trailer):
+        """Returns why a request is invalid, or None."""
+        if command not in board.COMMAND_NAMES \
+                or command in (board.CMD_ACK, board.CMD_NAK):
+            return "command"
+        if trailer!="\0":
+            return "trailer"
+        if command in RECT_COMMANDS:
+            if x+width>self.width or y+height>self.height:
+                return "range"
+            expected=width*height
+            if command in (board.CMD_READ_RAW, board.CMD_READ_LUM_RAW):
+                expected=0
+            if len(data)!=expected:
+                return "length"
+        elif command==board.CMD_WRITE_STD:
+            if x>=self.width or y>=self.height:
+                return "range"
+        elif command in (board.CMD_INTENSITY, board.CMD_WRITE_LUM_STD):
+            if len(data)!=1:
+                return "length"
+        elif command==board.CMD_LED_DRAW:
+            if y!=len(data):
+                return "length"
+            if x+len(data)>len(self.pixels):
+                return "range"
+        return None
+
+    def process(self, message):
+        """Applies one datagram to the display and returns the reply: an ACK
+        or NAK echoing the request, or the cells of a read. Datagrams too
+        short for a header get no reply."""
+        self.bytes+=len(message)
+        if len(message)<board.PACKET_OVERHEAD:
+            self.invalid["short"]=self.invalid.get("short", 0)+1
+            return None
+        command, x, y, width, height = struct.unpack("!HHHHH", message[0:10])
         data = message[10:len(message)-1]
-        #print command, x, y, width, height, data, len(data)
+        name=board.COMMAND_NAMES.get(command, str(command))
+        self.packets[name]=self.packets.get(name, 0)+1
+        reason=self.check(command, x, y, width, height, data, message[-1])
+        if reason is not None:
+            self.invalid[reason]=self.invalid.get(reason, 0)+1
+            return struct.pack("!HHHHH", board.CMD_NAK, x, y, width, height) \
+                + data + "\0"
+        if command in (board.CMD_READ_RAW, board.CMD_READ_LUM_RAW):
+            plane=self.char
+            if command==board.CMD_READ_LUM_RAW:
+                plane=self.lum
+            return struct.pack("!HHHHH", command, x, y, width, height) \
+                + self.read_rect(plane, x, y, width, height) + "\0"
         if command in (board.CMD_CLEAR, board.CMD_RESET, board.CMD_HARDRESET):
             self.clear()
         elif command == board.CMD_INTENSITY:
-            self.intensity(struct.unpack("b", data))
+            self.intensity(struct.unpack("b", data)[0])
         elif command == board.CMD_WRITE_LUM_RAW:
             self.display_luminance(x, y, width, height, data)
         elif command == board.CMD_WRITE_RAW:
             self.display_chars(x, y, width, height, data)
+        elif command == board.CMD_WRITE_STD:
+            self.write_std(x, y, data)
+        elif command == board.CMD_WRITE_LUM_STD:
+            self.std_lum=struct.unpack("b", data)[0]
+        elif command == board.CMD_LED_DRAW:
+            self.pixels[x:x+len(data)]=data
+        if command not in (board.CMD_WRITE_LUM_STD, board.CMD_REFRESH):
+            self.dirty=True
+            self.changed=True
         reply= \
-            struct.pack("HHHHH", board.CMD_ACK, x, y, width, height) \
+            struct.pack("!HHHHH", board.CMD_ACK, x, y, width, height) \
             + data \
             + struct.pack("b", 0)
-        self.sock.sendto(reply, client)
-    def listen(self):
-        print "%c[2J" % 27
+        return reply
+
+    def receive(self):
+        """Handles one waiting datagram. Returns False if there was none."""
+        try:
+            message, client = self.sock.recvfrom(2048)
+        except socket.error, err:
+            if err.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK): return False
+            raise
+        reply=self.process(message)
+        # no reply to a datagram too short to be a packet, nor to an
+        # unbound Unix socket, which cannot be answered
+        if reply is not None and client:
+            try:
+                self.sock.sendto(reply, client)
+            except socket.error:
+                pass # dropped, see transport.SocketTransport.send
+        return True
+
+    def bind(self):
+        """Binds the socket. A Unix socket left at the path by an earlier
+        run is replaced; anything else there is an error."""
+        if isinstance(self.host, str) and os.path.lexists(self.host):
+            if not stat.S_ISSOCK(os.lstat(self.host).st_mode):
+                raise ValueError("%s: exists and is not a socket"
+                    % self.host)
+            os.unlink(self.host) # stale socket of an earlier run
         self.sock.bind(self.host)
+        self.sock.setblocking(0)
+
+    def listen(self):
+        next_draw=0
         while True:
-            self.receive()
-            self.print_display()
+            timeout=None
+            if self.dirty and not self.quiet:
+                timeout=max(0, next_draw-time.time())
+            try:
+                select.select([self.sock], [], [], timeout)
+            except select.error: continue
+            while self.receive(): # drain, so that bursts become one redraw
+                pass
+            if self.changed and self.record is not None:
+                self.snapshot()
+            now=time.time()
+            if self.dirty and not self.quiet and now>=next_draw:
+                self.print_display()
+                next_draw=now+1.0/self.fps
 
-if __name__=="__main__":
-    s = Simulator()
+def usage():
+    print "Usage: simulator.py [-p|--port] [-u|--unix path] [-q|--quiet]" \
+        " [-f|--fps] [-r|--record FILE]"
+    print
+    print "--quiet runs headless. --record appends every frame, a burst of"
+    print "datagrams, with the packet statistics to FILE as a JSON line."
+
+def main():
+    port=board.NET_PORT
+    path=None
+    quiet=False
+    fps=25
+    record=None
+    try:
+        opts, args=getopt.getopt(sys.argv[1:], "hp:u:qf:r:",
+            ("help", "port=", "unix=", "quiet", "fps=", "record="))
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(1)
+    for o, a in opts:
+        if o in ("-h", "--help"): usage(); return
+        if o in ("-p", "--port"): port=int(a)
+        if o in ("-u", "--unix"): path=a
+        if o in ("-q", "--quiet"): quiet=True
+        if o in ("-f", "--fps"): fps=float(a)
+        if o in ("-r", "--record"): record=a
+    s = Simulator(port, path, quiet, fps, record)
+    try:
+        s.bind()
+    except (IOError, ValueError), err:
+        print str(err)
+        sys.exit(1)
     s.listen()
+
+if __name__=="__main__": main()
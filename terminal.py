@@ -3,112 +3,442 @@ import pty
 import os, sys
 import curses
 import termios
+import tty
 import subprocess
 import select
 import fcntl
+import stat
+import re
 import struct
 import random
 import string
-import copy
 import board
+import transport
+import delta
+import glyphs
+import pixelstream
+import recording
+import history
+import vt
+import scheduler
+import metrics
 import time
 import signal
 import getopt
+import asyncore
+import errno
+import collections
+
+READ_SIZE=65536
+
+# UTF-8 is shown one cell per character: a lead byte becomes a "?", the
+# continuation bytes are dropped
+UTF8_CELLS=string.maketrans("".join([chr(c) for c in range(0xc0, 0x100)]),
+    "?"*0x40)
+UTF8_CONTINUATION="".join([chr(c) for c in range(0x80, 0xc0)])
+
+# DEC special graphics, the line drawing character set, in ASCII
+DEC_GRAPHICS=string.maketrans("_`afgjklmnopqrstuvwxyz{|}~",
+    " *#o#+++++----+++++|<>*!f.")
+
+# control sequences by private marker, intermediates and final character
+CSI_HANDLERS={"A": "cursor_up", "B": "cursor_down", "e": "cursor_down",
+    "C": "cursor_forward", "a": "cursor_forward", "D": "cursor_backward",
+    "E": "cursor_next_line", "F": "cursor_previous_line",
+    "G": "cursor_column", "`": "cursor_column", "d": "cursor_row",
+    "H": "cursor_position", "f": "cursor_position",
+    "I": "tab_forward", "Z": "tab_backward",
+    "J": "erase_display", "K": "erase_line", "X": "erase_chars",
+    "@": "insert_chars", "P": "delete_chars",
+    "L": "insert_lines", "M": "delete_lines",
+    "S": "scroll_up", "T": "scroll_down",
+    "m": "select_graphic_rendition", "r": "set_margins",
+    "?h": "set_dec_modes", "?l": "reset_dec_modes",
+    "h": "ignore", "l": "ignore", # ANSI modes, e.g. insert mode
+    "g": "clear_tab_stops", "n": "device_status", "c": "device_attributes",
+    ">c": "secondary_device_attributes", "s": "save_cursor",
+    "u": "restore_cursor", "!p": "soft_reset"}
+
+def param(params, i=0, default=1):
+    """Returns parameter i of a control sequence, default if it is left out
+    or 0."""
+    if i<len(params) and params[i]:
+        return params[i]
+    return default
+
+# never written by the parser, marks cells whose board state is unknown
+INVALID_CELLS=bytearray("\xff"*board.DSP_WIDTH)
+
+PTY_READ_TIME=metrics.registry.histogram("stage_seconds", stage="pty_read")
+PARSE_TIME=metrics.registry.histogram("stage_seconds", stage="parse")
+BUFFER_TIME=metrics.registry.histogram("stage_seconds", stage="buffer")
+ENCODE_TIME=metrics.registry.histogram("stage_seconds", stage="encode")
+RENDER_TIME=metrics.registry.histogram("stage_seconds", stage="render")
+PTY_BYTES=metrics.registry.counter("pty_bytes_total")
+SCROLLS_UP=metrics.registry.counter("scrolls_total", direction="up")
+SCROLLS_DOWN=metrics.registry.counter("scrolls_total", direction="down")
+
+# keys of the scrollback view, in pages: shift page up and down in xterm
+SCROLLBACK_KEYS={"\x1b[5;2~": 1, "\x1b[6;2~": -1}
+
+# the lines of --pipe: escape sequences are dropped, other controls shown
+# as blanks and UTF-8 as in UTF8_CELLS
+PIPE_ESCAPE_RE=re.compile(r"\x1b(\[[\x30-\x3f]*[\x20-\x2f]*)?[\x40-\x7e]?")
+PIPE_CELLS=string.maketrans("".join([chr(c) for c in range(0x20)])+"\x7f"
+    +"".join([chr(c) for c in range(0xc0, 0x100)]), " "*0x21+"?"*0x40)
+PIPE_BACKLOG=100 # rows waiting to be shown, older ones are skipped
+PIPE_LINES=metrics.registry.counter("pipe_lines_total")
+PIPE_SKIPPED=metrics.registry.counter("pipe_skipped_total")
 
 class Buffer:
-    def __init__(self):
-        self.char = []
-        self.lum = []
+    """Cell grid stored as two flat bytearrays, row after row."""
+    def __init__(self, width=board.DSP_WIDTH, height=board.DSP_HEIGHT):
+        self.width=width
+        self.height=height
+        self.char=bytearray(" "*(width*height))
+        self.lum=bytearray(width*height)
+        self.blank_chars=bytearray(" "*(width*height))
+        self.blank_lum=bytearray(width*height)
         self.latency=-1
-        for i in range(board.DSP_HEIGHT):
-            ll=[]
-            cl=[]
-            for j in range(board.DSP_WIDTH):
-                ll.append(0)
-                cl.append(" ")
-            self.char.append(cl)
-            self.lum.append(ll)
-
-    def curses_render(self, window):
-        """Respects border."""
-        for i in range(board.DSP_HEIGHT):
-            for j in range(board.DSP_WIDTH):
-                window.addch(i+1,j+1, ord(self.char[i][j]))
-        window.refresh()
+
+    def copy_from(self, other):
+        """Makes this buffer a snapshot of other, without allocating."""
+        self.char[:]=other.char
+        self.lum[:]=other.lum
+
+    def index(self, row, col):
+        if not (0<=row<self.height and 0<=col<self.width):
+            raise IndexError("cell out of range: %d, %d" % (row, col))
+        return row*self.width+col
+
+    def write(self, row, col, text, lum):
+        """Writes text into a single row, starting at col."""
+        i=self.index(row, col)
+        self.index(row, col+len(text)-1)
+        self.char[i:i+len(text)]=text
+        self.lum[i:i+len(text)]=chr(lum)*len(text)
+
+    def copy_rect(self, dest, src, x, y, width, height):
+        """Copies a rectangle from plane src to plane dest."""
+        for o in range(y*self.width+x, (y+height)*self.width,
+                self.width):
+            dest[o:o+width]=src[o:o+width]
+
+    def blit(self, src, x, y):
+        """Copies all of buffer src into this buffer at x, y."""
+        for i in range(src.height):
+            o=(y+i)*self.width+x
+            self.char[o:o+src.width]=src.char[i*src.width:(i+1)*src.width]
+            self.lum[o:o+src.width]=src.lum[i*src.width:(i+1)*src.width]
 
     def getcell_compat(self, row, col):
-        return [self.char[row][col], self.lum[row][col]]
+        i=self.index(row, col)
+        return [chr(self.char[i]), self.lum[i]]
 
     def setcell_compat(self, row, col, cell):
-        self.char[row][col]=cell[0]
-        self.lum[row][col]=cell[1]
+        i=self.index(row, col)
+        self.char[i]=cell[0]
+        self.lum[i]=cell[1]
+
+class CursesMirror:
+    """Shows a Buffer inside the border of a curses window. Only the runs of
+    cells that differ from what the window shows are drawn."""
+    def __init__(self, window, width=board.DSP_WIDTH,
+            height=board.DSP_HEIGHT):
+        self.window=window
+        self.shown=Buffer(width, height)
+
+    def render(self, buffer, overlay=None):
+        """overlay is drawn like in TermBuffer.delta_transmit."""
+        under=None
+        if overlay is not None:
+            try:
+                under=buffer.getcell_compat(overlay[0], overlay[1])
+                buffer.setcell_compat(overlay[0], overlay[1], overlay[2])
+            except IndexError: pass
+        try:
+            damaged=self.draw(buffer)
+        finally:
+            if under is not None:
+                buffer.setcell_compat(overlay[0], overlay[1], under)
+        if damaged:
+            self.window.refresh()
+
+    def draw(self, buffer):
+        damaged=False
+        width=buffer.width
+        for i in range(buffer.height):
+            start=i*width
+            spans=delta.row_spans(self.shown.char, buffer.char, start,
+                start+width)
+            for a, b in spans:
+                self.window.addstr(i+1, a+1,
+                    str(buffer.char[start+a:start+b+1]))
+            if spans:
+                self.shown.char[start:start+width]= \
+                    buffer.char[start:start+width]
+                damaged=True
+        return damaged
 
 class TermBuffer(Buffer):
-    def delta_transmit(self, bd, previous, colored=False):
+    def __init__(self, width=board.DSP_WIDTH, height=board.DSP_HEIGHT):
+        Buffer.__init__(self, width, height)
+        self.scrolls=[] # [first, last, lines] since the last delta_transmit
+        self.history=None # a Scrollback for the rows leaving the screen
+        self.std_lum=None # of CMD_WRITE_STD on the board, for a previous
+
+    def log_scroll(self, scroll_range, lines):
+        """Batches the scrolls of a frame: consecutive scrolls of the same
+        region add up."""
+        if self.scrolls and self.scrolls[-1][:2]==list(scroll_range):
+            self.scrolls[-1][2]+=lines
+        else:
+            self.scrolls.append([scroll_range[0], scroll_range[1], lines])
+
+    def delta_transmit(self, bd, previous, colored=False, overlay=None):
+        """Sends the changes against previous, which is updated to match.
+        overlay is an optional (row, col, cell) drawn over this buffer for
+        the transmission only, e.g. the cursor."""
         t=time.time()
-        self.nu_delta_transmit(bd, previous, colored)
+        under=None
+        if overlay is not None:
+            try:
+                under=self.getcell_compat(overlay[0], overlay[1])
+                self.setcell_compat(overlay[0], overlay[1], overlay[2])
+            except IndexError: pass
+        try:
+            self.rect_delta_transmit(bd, previous, colored)
+        finally:
+            if under is not None:
+                self.setcell_compat(overlay[0], overlay[1], under)
+        self.scrolls=[]
         self.latency=time.time()-t
 
+    def invalidate(self, command, x, y, width, height):
+        """Marks the cells of a lost write as unknown, so that the next
+        delta_transmit against this buffer sends them again."""
+        plane=self.char
+        if command==board.CMD_WRITE_LUM_RAW:
+            plane=self.lum
+        width=min(width, self.width-x)
+        for o in range(y*self.width+x, min(y+height, self.height)*self.width,
+                self.width):
+            plane[o:o+width]=INVALID_CELLS[:width]
+
+    def resend(self, bd, lost):
+        """Sends bd the cells of its lost writes, see Board.take_lost, as
+        this buffer holds them. The regions are sent once each, or the whole
+        plane if that is cheaper, as for a target far out of sync."""
+        for command, plane in ((board.CMD_WRITE_RAW, self.char),
+                (board.CMD_WRITE_LUM_RAW, self.lum)):
+            rects=set([(x, y, min(w, self.width-x), min(h, self.height-y))
+                for c, x, y, w, h in lost if c==command])
+            if sum([delta.packet_cost(w, h) for x, y, w, h in rects]) \
+                    >=delta.packet_cost(self.width, self.height):
+                rects=[(0, 0, self.width, self.height)]
+            for x, y, w, h in sorted(rects):
+                bd.write_rect(command, plane, self.width, x, y, w, h)
+
     def nu_delta_transmit(self, bd, previous, colored):
-        bd.display_chars(self.char)
-        if colored: bd.display_luminance(self.lum)
-
-    def old_delta_transmit(self, bd, previous, colored):
-        for i in range(board.DSP_HEIGHT):
-            for j in range(board.DSP_WIDTH):
-                t = previous.getcell_compat(i, j)
-                n = self.getcell_compat(i, j)
-                if t[0]!=n[0]:
-                    bd.display_chars([[n[0]]], x=j, y=i)
-                    t[0]=n[0]
-                if not colored: continue
-                if t[1]!=n[1]:
-                    bd.display_luminance([[n[1]]], x=j, y=i)
-                    t[1]=n[1]
-
-    def clear_down(self, cursor):
-        # this might be buggy
-        for i in range(board.DSP_HEIGHT-cursor[1]-1):
-            for j in range(board.DSP_WIDTH):
-                self.setcell_compat(cursor[1]+i, j, [" ", 0])
-
-    def clear_line(self, cursor):
-        for i in range(board.DSP_WIDTH-cursor[0]):
-            try:
-                self.setcell_compat(cursor[1], cursor[0]+i,[" ", board.LUM_MAX])
-            except: pass
-    
-    def scroll(self, scroll_range):
-        # append new line
-        lc=[]
-        ll=[]
-        for i in range(board.DSP_WIDTH):
-            lc.append(" ")
-        for i in range(board.DSP_WIDTH):
-            ll.append(0)
-        self.char.pop(scroll_range[0])
-        self.char.insert(scroll_range[1], lc)
-        self.lum.pop(scroll_range[0])
-        self.lum.insert(scroll_range[1], ll)
-
-    def scroll_up(self, scroll_range):
-        lc=[]
-        ll=[]
-        for i in range(board.DSP_WIDTH):
-            ll.append(0)
-            lc.append(" ")
-
-        self.lum.pop(scroll_range[1])
-        self.lum.insert(scroll_range[0], ll)
-        self.char.pop(scroll_range[1])
-        self.char.insert(scroll_range[0], lc)
+        bd.display_chars(self.char, width=self.width)
+        if colored: bd.display_luminance(self.lum, width=self.width)
+
+    def rect_delta_transmit(self, bd, previous, colored):
+        """Sends only the rectangles that differ from previous, or the full
+        frame if that is cheaper. Scrolled regions are encoded as bands.
+
+        The luminance of blank cells does not show and is not sent, see
+        delta.lum_planes. Unless bd is reliable, which only tracks raw
+        writes, a frame whose cells all show in one luminance is set with
+        CMD_INTENSITY, and a run of characters in one luminance is written
+        together with it by CMD_WRITE_STD."""
+        bands=[(first, last) for first, last, lines in self.scrolls
+            if lines!=0]
+        fast=colored and not bd.reliable()
+        if colored:
+            with ENCODE_TIME:
+                target, shown = delta.lum_planes(self.char, self.lum,
+                    previous.lum)
+            if fast and target!=previous.lum:
+                self.intensity_transmit(bd, previous, target, shown, bands)
+        with ENCODE_TIME:
+            rects=delta.frame_rects(previous.char, self.char, self.width,
+                bands)
+        for x, y, w, h in rects:
+            if fast and self.std_transmit(bd, previous, target, shown,
+                    x, y, w, h):
+                continue
+            bd.write_rect(board.CMD_WRITE_RAW, self.char, self.width,
+                x, y, w, h)
+            self.copy_rect(previous.char, self.char, x, y, w, h)
+        if not colored: return
+        with ENCODE_TIME:
+            rects=delta.frame_rects(previous.lum, target, self.width, bands)
+        for x, y, w, h in rects:
+            bd.write_rect(board.CMD_WRITE_LUM_RAW, target, self.width,
+                x, y, w, h)
+            self.copy_rect(previous.lum, target, x, y, w, h)
+
+    def intensity_transmit(self, bd, previous, target, shown, bands):
+        """Sets the luminance of all cells at once, if they all show in the
+        same one and that is cheaper than the raw writes."""
+        level=delta.uniform_lum(shown)
+        if level is None: return
+        with ENCODE_TIME:
+            rects=delta.frame_rects(previous.lum, target, self.width, bands)
+        if sum([delta.packet_cost(w, h) for x, y, w, h in rects]) \
+                <=delta.packet_cost(1, 1):
+            return
+        bd.set_luminance(level)
+        previous.lum[:]=chr(level)*len(previous.lum)
+        target[:]=previous.lum
+
+    def std_transmit(self, bd, previous, target, shown, x, y, w, h):
+        """Writes the characters of a rectangle that is one run of cells
+        with CMD_WRITE_STD, if their luminance changed and all that show
+        have the same one. Returns whether it did."""
+        if h>1 and w<self.width: return False # not one run
+        o=y*self.width+x
+        n=w*h
+        if target[o:o+n]==previous.lum[o:o+n]: return False
+        level=delta.uniform_lum(shown[o:o+n])
+        if level is None: return False
+        if previous.std_lum!=level:
+            bd.send(board.CMD_WRITE_LUM_STD, data=struct.pack("b", level))
+            previous.std_lum=level
+        bd.write(str(self.char[o:o+n]), x, y)
+        previous.char[o:o+n]=self.char[o:o+n]
+        previous.lum[o:o+n]=chr(level)*n
+        target[o:o+n]=previous.lum[o:o+n]
+        return True
+
+    def erase(self, start, end):
+        """Blanks the cells from index start up to end."""
+        if start>=end: return
+        self.char[start:end]=self.blank_chars[:end-start]
+        self.lum[start:end]=self.blank_lum[:end-start]
+
+    def insert_chars(self, row, col, n):
+        """Shifts the cells from col on right by n, within the row."""
+        o=row*self.width
+        n=min(n, self.width-col)
+        for plane in (self.char, self.lum):
+            plane[o+col+n:o+self.width]=plane[o+col:o+self.width-n]
+        self.erase(o+col, o+col+n)
+
+    def delete_chars(self, row, col, n):
+        """Shifts the cells right of col+n left by n, within the row."""
+        o=row*self.width
+        n=min(n, self.width-col)
+        for plane in (self.char, self.lum):
+            plane[o+col:o+self.width-n]=plane[o+col+n:o+self.width]
+        self.erase(o+self.width-n, o+self.width)
+
+    def scroll(self, scroll_range, lines=1, save=True):
+        """Moves the rows of scroll_range up, blanking lines at the bottom.
+        With save, rows leaving the top of the screen go into the
+        history."""
+        SCROLLS_UP.inc(lines)
+        lines=min(lines, scroll_range[1]-scroll_range[0]+1)
+        self.log_scroll(scroll_range, lines)
+        top=scroll_range[0]*self.width
+        bottom=(scroll_range[1]+1)*self.width
+        n=lines*self.width
+        if save and self.history is not None and top==0:
+            for o in range(0, n, self.width):
+                self.history.append(self.char[o:o+self.width],
+                    self.lum[o:o+self.width])
+        self.char[top:bottom-n]=self.char[top+n:bottom]
+        self.lum[top:bottom-n]=self.lum[top+n:bottom]
+        self.erase(bottom-n, bottom)
+
+    def scroll_up(self, scroll_range, lines=1):
+        """Moves the rows of scroll_range down, blanking lines at the
+        top."""
+        SCROLLS_DOWN.inc(lines)
+        lines=min(lines, scroll_range[1]-scroll_range[0]+1)
+        self.log_scroll(scroll_range, -lines)
+        top=scroll_range[0]*self.width
+        bottom=(scroll_range[1]+1)*self.width
+        n=lines*self.width
+        self.char[top+n:bottom]=self.char[top:bottom-n]
+        self.lum[top+n:bottom]=self.lum[top:bottom-n]
+        self.erase(top, top+n)
+
+class PtyChannel(asyncore.file_dispatcher):
+    """Reads terminal output from the PTY and writes queued input to it."""
+    def __init__(self, terminal, map):
+        asyncore.file_dispatcher.__init__(self, terminal.master, map)
+        self.terminal=terminal
+        self.input=""
+        self.alive=True
+
+    def writable(self):
+        return self.input!=""
+
+    def handle_write(self):
+        try:
+            self.input=self.input[os.write(self.terminal.master,
+                self.input):]
+        except OSError, err:
+            if err.errno!=errno.EAGAIN: self.handle_close()
+
+    def handle_read(self):
+        try:
+            with PTY_READ_TIME:
+                data=os.read(self.terminal.master, READ_SIZE)
+        except OSError, err:
+            if err.errno==errno.EAGAIN: return
+            data="" # EIO, child has exited
+        if data=="":
+            self.handle_close()
+            return
+        self.terminal.output_received(data)
+
+    def handle_close(self):
+        self.alive=False
+        self.close()
+
+class StdinChannel(asyncore.file_dispatcher):
+    """Forwards keyboard input to a PtyChannel."""
+    def __init__(self, pty_channel, map):
+        asyncore.file_dispatcher.__init__(self, 0, map)
+        # stdin shares its file status flags with the curses output
+        flags=fcntl.fcntl(0, fcntl.F_GETFL)
+        fcntl.fcntl(0, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+        self.pty_channel=pty_channel
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.pty_channel.input+=self.pty_channel.terminal.keyboard_input(
+            os.read(0, READ_SIZE))
 
 class Terminal:
-    def __init__(self):
+    def __init__(self, width=board.DSP_WIDTH, height=board.DSP_HEIGHT,
+            command=None, spawn=True):
+        """Starts the shell, or command through the shell, in a PTY of
+        width x height cells. Without spawn there is no child process and
+        output is fed in through char_processor."""
+        self.width=width
+        self.height=height
         self.debug_mode=False
         self.debug_no=0
         self.colored=False
-        self.fps=30
+        self.async_mode=False
+        self.exporter=None
+        self.recorder=None
+        self.fps=30 # upper bound, frames are only sent after changes
+        self.mirror_fps=10 # of the curses mirror, throttled on its own
+        self.mirror=None
+        self.text_renderer=None # pixel mode, see use_pixels
+        self.pixel_stream=None
+        self.history=history.Scrollback(width)
+        self.scrollback_offset=0 # rows the view is scrolled back, 0 is live
+        self.scrollback_view=TermBuffer(width, height)
+        self.win_status=None
+        self.win_debug=None
         self.style2lum_dict={0:10, 7:10, # white
             6:3, 5:3, 4:3, 3:3, 2:3, 1:3}
         #self.visual_cursor=["\xdb", 7] # block cursor
@@ -117,218 +447,557 @@ class Terminal:
         self.cursor_blink_interval=0.5
         self.cursor_blink_state=0 
 
+        self.last_stat=time.time()
+        self.stat_interval=5
+        self.stat_outbits=[0]*int(self.stat_interval
+            /self.cursor_blink_interval)
+
+        self.master=None
+        if spawn:
+            self.spawn(command)
+
+        self.parser=vt.Parser(self)
+        self.csi_handlers=dict([(key, getattr(self, name))
+            for key, name in CSI_HANDLERS.items()])
+        self.title=""
+        self.cursor=[0,0]
+        self.transmitted_display=TermBuffer(width, height)
+        self.reset()
+
+    def spawn(self, command=None):
         self.slave, self.master = pty.fork()
         if self.slave==0:
             os.environ["DISPLAY"]=""
             os.environ["TERM"]="vt100"
-            os.execl(os.environ["SHELL"], "")
+            if command is None:
+                os.execl(os.environ["SHELL"], "")
+            os.execl(os.environ["SHELL"], "", "-c", command)
 
         self.term = os.fdopen(self.master, "r", 0)
 
         fcntl.ioctl(self.master, termios.TIOCSWINSZ,
-            struct.pack("hhhh", board.DSP_HEIGHT, board.DSP_WIDTH, 0, 0))
+            struct.pack("hhhh", self.height, self.width, 0, 0))
 
         attr = termios.tcgetattr(self.master)
         attr[3] &= ~termios.ICANON
         termios.tcsetattr(self.master, termios.TCSAFLUSH, attr)
 
-        self.cursor=[0,0]
-        self.multichar_buffer=""
+    def connect(self, hosts, port, dry_run=False, reliable=False,
+            packet_rate=board.PACE_PACKETS, byte_rate=None):
+        """Sends the frames to every host in hosts, encoded once, see
+        board.Fanout. Each host is paced on its own, see board.Pacer;
+        without rates the packets go out as they come."""
+        targets=[]
+        for host in hosts:
+            pacer=None
+            if packet_rate or byte_rate:
+                pacer=board.Pacer(packet_rate, byte_rate)
+            targets.append(board.Board(dry_run=dry_run, reliable=reliable,
+                transport=transport.open_transport(host, port), pacer=pacer))
+        self.board=targets[0]
+        if len(targets)>1:
+            self.board=board.Fanout(targets)
+        self.scheduler=scheduler.FrameScheduler(self.fps)
+        self.mirror_scheduler=scheduler.FrameScheduler(self.mirror_fps,
+            "mirror")
+    
+    def use_pixels(self, font=None, keyframe_interval=None):
+        """Draws the text into the board's pixel mode bitmap instead of
+        sending it in text mode. font is a list of 256 glyphs, see
+        glyphs.load_psf; the default is glyphs.builtin_font. See
+        pixelstream.PixelStream for keyframe_interval."""
+        if font is None:
+            font=glyphs.builtin_font()
+        self.text_renderer=glyphs.TextRenderer(glyphs.GlyphAtlas(font),
+            self.colored, self.width, self.height)
+        self.pixel_stream=pixelstream.PixelStream(self.board,
+            keyframe_interval)
 
-        self.style_lum=self.style2lum_dict[7]
+    def record(self, path):
+        """Records the PTY output and the board packets into path, see
+        recording.py."""
+        self.recorder=recording.Recorder(path)
+        self.board.recorder=self.recorder
 
-        self.transmitted_display=TermBuffer()
-        self.clear()
-        
-        # this fixes carriage returns as last character in a line (width +
-        # 1st).. only \n and any escape sequence reset this variable.. (and
-        # carriage return itself)
-        self.last_wrapped=False
+    def set_scrollback(self, lines, max_bytes=history.SCROLLBACK_BYTES):
+        """Limits the scrollback; 0 lines turn it off."""
+        self.history=None
+        if lines>0:
+            self.history=history.Scrollback(self.width, lines, max_bytes)
+        self.display.history=self.history
+        self.scrollback_offset=0
 
-    def connect(self, host, port, dry_run=False):
-        self.board=board.Board(host, port, dry_run=dry_run)
-    
     def handler_sigint(self, s, frame): # ^C received
         os.write(self.master, "\x03")
         return signal.SIG_IGN
 
-    def clear(self):
-        self.display=TermBuffer()
+    def reset(self):
+        """Puts the terminal into its initial state, as ESC c."""
+        self.display=TermBuffer(self.width, self.height)
+        self.display.history=self.history
+        self.main_display=None # while the alternate screen is shown
+        self.tab_stops=[col>0 and col%8==0 for col in range(self.width)]
+        self.soft_reset()
+        self.move_to(0, 0)
+
+    def soft_reset(self, params=None):
+        """Resets the modes, margins and character style, as DECSTR."""
         self.cursor_visible=True
-        self.scroll_range=[0, board.DSP_HEIGHT-1]
+        self.autowrap=True
+        self.origin=False
+        self.wrap_pending=False # the last column is written, see print_run
+        self.scroll_range=[0, self.height-1]
+        self.style_lum=self.style2lum_dict[7]
+        self.charsets=[None, None] # G0 and G1, None is ASCII
+        self.shift=0 # G0 or G1 is in use
+        self.saved_cursor=None
 
     def delta_transmit(self):
 #        self.debug("update.")
-        self.display.delta_transmit(self.board, self.transmitted_display,
-            self.colored)
-        self.transmitted_display=copy.deepcopy(self.display)
-        self.display.curses_render(self.win_term)
+        buffer=self.visible()
+        overlay=self.cursor_overlay()
+        if self.pixel_stream is not None:
+            t=time.time()
+            with ENCODE_TIME:
+                if overlay is None:
+                    self.text_renderer.render(buffer)
+                else: # at the luminance of the visual cursor, as in text
+                    self.text_renderer.render(buffer, overlay[:2],
+                        overlay[2][1])
+            self.pixel_stream.send(self.text_renderer.bitmap)
+            buffer.latency=time.time()-t
+        else:
+            buffer.delta_transmit(self.board, self.transmitted_display,
+                self.colored, overlay)
+        self.display.scrolls=[]
+        if self.mirror is not None:
+            self.mirror_scheduler.mark_dirty()
 
-    def new_line(self, wrap=False):
-        self.cursor[0]=0
-        self.last_wrapped=wrap
-        if self.cursor[1]>=(self.scroll_range[1]):
+    def mirror_render(self):
+        with RENDER_TIME:
+            self.mirror.render(self.visible(), self.cursor_overlay())
+
+    def visible(self):
+        """Returns the display, or while scrolled back a buffer with the
+        rows of the scrollback above the top of the display."""
+        if not self.scrollback_offset:
+            return self.display
+        view=self.scrollback_view
+        w=self.width
+        first=len(self.history)-self.scrollback_offset
+        n=min(self.scrollback_offset, self.height)
+        for i in range(n):
+            view.char[i*w:(i+1)*w], view.lum[i*w:(i+1)*w] = \
+                self.history.row(first+i)
+        view.char[n*w:]=self.display.char[:(self.height-n)*w]
+        view.lum[n*w:]=self.display.lum[:(self.height-n)*w]
+        return view
+
+    def scroll_back(self, lines):
+        """Moves the view lines further into the scrollback, or towards the
+        live display for negative lines."""
+        offset=max(0, min(self.scrollback_offset+lines, len(self.history)))
+        if offset==self.scrollback_offset: return
+        self.scrollback_view.log_scroll([0, self.height-1],
+            offset-self.scrollback_offset)
+        self.scrollback_offset=offset
+        self.scheduler.mark_dirty()
+
+    def keyboard_input(self, data):
+        """Returns the input for the PTY. The keys in SCROLLBACK_KEYS page
+        through the scrollback; any other key first returns to the live
+        display."""
+        if self.history is None:
+            return data
+        if data in SCROLLBACK_KEYS:
+            self.scroll_back(SCROLLBACK_KEYS[data]*(self.height-1))
+            return ""
+        self.scroll_back(-self.scrollback_offset)
+        return data
+
+    def move_to(self, col, row):
+        """Moves the cursor, clipped to the screen."""
+        self.cursor[0]=max(0, min(col, self.width-1))
+        self.cursor[1]=max(0, min(row, self.height-1))
+        self.wrap_pending=False
+
+    def line_feed(self):
+        """Moves the cursor down, scrolling at the bottom margin."""
+        self.wrap_pending=False
+        if self.cursor[1]==self.scroll_range[1]:
             self.display.scroll(self.scroll_range)
-        else:
+        elif self.cursor[1]<self.height-1:
             self.cursor[1]+=1
 
-    def cursor_incr(self):
-        if self.cursor[0]>=(board.DSP_WIDTH-1):
-            self.new_line(True)
-        else:
-            self.cursor[0]+=1
-    
-    def style(self, key):
-        try:
-            key=int(key)
-        except:
-            key=0
-        if key==0:
-            self.style_lum=self.style2lum_dict[7]
-        elif 30<=key<=37:
-            col=key-30
-            self.style_lum=self.style2lum_dict[col] 
-        
-    def process_escape_sequence(self, sequence):
-        s = sequence[1:len(sequence)]
-        cmd = sequence[len(sequence)-1]
-        arg = s[1:len(s)-1]
-        unhandled=0
-        self.last_wrapped=False
-        if s.startswith("?"): # drop that ^^
-            return
-
-        if cmd=="m": # character style
-            for a in arg.split(";"):
-                if a=="":
-                    continue
-                self.style(a)
-        elif cmd=="K":
-            self.display.clear_line(self.cursor)
-        elif cmd=="r":
-            try:
-                b, e = arg.split(";")
-                try:
-                    b=int(b)-1
-                    e=int(e)-1
-                    self.scroll_range=[b, e]
-                except: pass
-            except:
-                self.scroll_range=[0, board.DSP_HEIGHT-1]
-        elif cmd=="h" and arg=="?25":
-            self.cursor_visible=True
-        elif cmd=="l" and arg=="?25":
-            self.cursor_visible=False
-        elif cmd=="B":
-            if arg=="":
-                arg=1
-            try:
-                self.cursor[1]+=int(arg)
-            except: pass
-        elif cmd=="M": # scroll up 1 line
+    def reverse_index(self):
+        self.wrap_pending=False
+        if self.cursor[1]==self.scroll_range[0]:
             self.display.scroll_up(self.scroll_range)
-        elif cmd=="C": # move cursor forward
-            try:
-                self.cursor[0]+=int(arg)
-            except:
-                self.cursor[0]+=1
-        elif cmd=="D": # move cursor backward
-            self.cursor[0]-=int(arg)
-        elif cmd=="G":
-            try: self.cursor[0]=int(arg)
-            except: pass
-        elif cmd=="A": # move cursor UP
-            if arg=="":
-                arg=1
-            self.cursor[1]-=int(arg)
-        elif cmd in ("H", "f"):
-            if len(arg)==0:
-                self.cursor=[0,0]
-            else:
-                try:
-                    y,x=arg.split(";")
-                    if x=="" and y=="":
-                        self.cursor=[0,0]
-                    else:
-                        self.cursor=[int(x)-1, int(y)-1]
-                except: pass
-        elif cmd=="J": # clear
-            i=0
-            if arg!="":
-                try:
-                    i=int(arg)
-                except: pass
-            if i==1:
-                unhandled="Clear upwards"
-            elif i==0:
-                self.display.clear_down(self.cursor)
-            elif i==2:
-                self.clear()
-        else:
-            unhandled="Unknown"
-        
-        if unhandled:
-            self.debug("Unhandled escape sequence: cmd=%s, arg=%s (%s)" %
-                (cmd, arg, unhandled))
-
-    def char_processor(self, char):
-        if self.multichar_buffer=="":
-            if char in string.letters+string.digits+string.punctuation+" ":
-                try:
-                    self.display.setcell_compat(self.cursor[1],
-                        self.cursor[0], [char.encode("CP437"), self.style_lum])
-                    self.cursor_incr()
-                except: pass
-            elif char=="\x1b": # ANSI Escape
-                self.multichar_buffer+=char
-            elif char=="\r":
-                if self.cursor[0]==0 and self.last_wrapped:
-                    self.cursor[1]-=1
-                    self.last_wrapped=False
+        elif self.cursor[1]>0:
+            self.cursor[1]-=1
+
+    def margins(self):
+        """Returns the rows the cursor may move between vertically: the
+        scroll region while the cursor is inside it, else the screen."""
+        top, bottom = self.scroll_range
+        row=self.cursor[1]
+        if top<=row<=bottom:
+            return top, bottom
+        return 0, self.height-1
+
+    def print_run(self, text):
+        """Writes a run of printable characters at the cursor, wrapping at
+        the end of the line."""
+        if text[0]>"\x7f":
+            text=text.translate(UTF8_CELLS, UTF8_CONTINUATION)
+            if not text: return
+        if self.charsets[self.shift] is not None:
+            text=text.translate(self.charsets[self.shift])
+        with BUFFER_TIME:
+            self.print_wrapped(text)
+
+    def print_wrapped(self, text):
+        """Writing the last column of a line leaves the cursor there until
+        the next character, which goes to the next line, as in a VT100."""
+        i=0
+        while i<len(text):
+            if self.wrap_pending:
                 self.cursor[0]=0
-            elif char=="\n":
-                self.new_line()
-            elif char=="\b":
-                self.cursor[0]-=1
+                self.line_feed()
+            n=min(len(text)-i, self.width-self.cursor[0])
+            if not self.autowrap and len(text)-i>n: # the rest overwrites
+                text=text[:i+n-1]+text[-1]          # the last column
+            self.display.write(self.cursor[1], self.cursor[0],
+                text[i:i+n], self.style_lum)
+            i+=n
+            if self.cursor[0]+n>=self.width:
+                self.cursor[0]=self.width-1
+                self.wrap_pending=self.autowrap
             else:
-                self.debug("Unknown char %02x"%ord(char))
-        else:
-            # process escape sequences
-            self.multichar_buffer+=char
-            if char in string.letters:
-                self.process_escape_sequence(self.multichar_buffer)
-                self.multichar_buffer=""
-            if len(self.multichar_buffer)>10:
-                print "Multichar buffer overflow:", self.multichar_buffer
-                self.multichar_buffer=""
-                sys.exit(1)
-    
-    def cursor_refresh(self):
-        if not self.cursor_visible: return
-        if self.cursor_blink_state:
-            temp_display=copy.deepcopy(self.display)
-            try:
-                self.display.setcell_compat(self.cursor[1], self.cursor[0],
-                    self.visual_cursor)
-                self.delta_transmit()
-                self.display=temp_display
-            except: pass
+                self.cursor[0]+=n
+
+    def execute(self, code):
+        """Handles a C0 control character."""
+        if code in (0x0a, 0x0b, 0x0c): # LF, VT, FF
+            self.line_feed()
+        elif code==0x0d: # CR
+            self.cursor[0]=0
+            self.wrap_pending=False
+        elif code==0x08: # BS
+            self.move_to(self.cursor[0]-1, self.cursor[1])
+        elif code==0x09: # HT
+            self.tab_forward()
+        elif code==0x0e: # SO
+            self.shift=1
+        elif code==0x0f: # SI
+            self.shift=0
+        elif code==0x07: # BEL
+            pass
+        elif self.debug_mode:
+            self.debug("Unknown char %02x" % code)
+
+    def esc_dispatch(self, intermediates, final):
+        if intermediates=="":
+            if final=="7":
+                self.save_cursor()
+            elif final=="8":
+                self.restore_cursor()
+            elif final=="D": # IND
+                self.line_feed()
+            elif final=="E": # NEL
+                self.cursor[0]=0
+                self.line_feed()
+            elif final=="M": # RI
+                self.reverse_index()
+            elif final=="H": # HTS
+                self.tab_stops[self.cursor[0]]=True
+            elif final=="c": # RIS
+                self.reset()
+            elif final in "=>\\": # keypad modes, string terminator
+                pass
+            elif self.debug_mode:
+                self.debug("Unhandled escape sequence: %s" % final)
+        elif intermediates in ("(", ")"): # designates G0 or G1
+            charset=None
+            if final=="0":
+                charset=DEC_GRAPHICS
+            self.charsets[intermediates==")"]=charset
+        elif intermediates=="#" and final=="8": # DECALN
+            self.display.char[:]="E"*len(self.display.char)
+        elif self.debug_mode:
+            self.debug("Unhandled escape sequence: %s%s"
+                % (intermediates, final))
+
+    def csi_dispatch(self, params, intermediates, final):
+        handler=self.csi_handlers.get(intermediates+final)
+        if handler is not None:
+            handler(params)
+        elif self.debug_mode:
+            self.debug("Unhandled control sequence: %s %s%s"
+                % (params, intermediates, final))
+
+    def osc_dispatch(self, data):
+        """Keeps the window title of OSC 0 and 2; other operating system
+        commands, such as colour changes, mean nothing on the board."""
+        code, sep, text = data.partition(";")
+        if code in ("0", "2"):
+            self.title=text
+
+    def dcs_dispatch(self, params, intermediates, final, data):
+        """Device control strings, like sixel graphics or tmux passthrough,
+        are dropped."""
+        pass
+
+    def respond(self, data):
+        """Answers a query of the program."""
+        if self.master is None: return
+        try:
+            os.write(self.master, data)
+        except OSError:
+            pass
+
+    def ignore(self, params):
+        pass
+
+    def cursor_up(self, params):
+        top, bottom = self.margins()
+        self.move_to(self.cursor[0], max(top, self.cursor[1]-param(params)))
+
+    def cursor_down(self, params):
+        top, bottom = self.margins()
+        self.move_to(self.cursor[0],
+            min(bottom, self.cursor[1]+param(params)))
+
+    def cursor_forward(self, params):
+        self.move_to(self.cursor[0]+param(params), self.cursor[1])
+
+    def cursor_backward(self, params):
+        self.move_to(self.cursor[0]-param(params), self.cursor[1])
+
+    def cursor_next_line(self, params):
+        self.cursor_down(params)
+        self.cursor[0]=0
+
+    def cursor_previous_line(self, params):
+        self.cursor_up(params)
+        self.cursor[0]=0
+
+    def cursor_column(self, params):
+        self.move_to(param(params)-1, self.cursor[1])
+
+    def cursor_row(self, params):
+        row=param(params)-1
+        if self.origin:
+            row=min(row+self.scroll_range[0], self.scroll_range[1])
+        self.move_to(self.cursor[0], row)
+
+    def cursor_position(self, params):
+        row=param(params, 0)-1
+        if self.origin:
+            row=min(row+self.scroll_range[0], self.scroll_range[1])
+        self.move_to(param(params, 1)-1, row)
+
+    def tab_forward(self, params=()):
+        col=self.cursor[0]
+        for i in range(param(params)):
+            col+=1
+            while col<self.width-1 and not self.tab_stops[col]:
+                col+=1
+        self.move_to(col, self.cursor[1])
+
+    def tab_backward(self, params):
+        col=self.cursor[0]
+        for i in range(param(params)):
+            col-=1
+            while col>0 and not self.tab_stops[col]:
+                col-=1
+        self.move_to(col, self.cursor[1])
+
+    def clear_tab_stops(self, params):
+        mode=param(params, 0, 0)
+        if mode==0:
+            self.tab_stops[self.cursor[0]]=False
+        elif mode==3:
+            self.tab_stops=[False]*self.width
+
+    def erase_display(self, params):
+        mode=param(params, 0, 0)
+        i=self.cursor[1]*self.width+self.cursor[0]
+        if mode==0:
+            self.display.erase(i, self.width*self.height)
+        elif mode==1:
+            self.display.erase(0, i+1)
+        elif mode==2:
+            self.display.erase(0, self.width*self.height)
+        elif mode==3 and self.history is not None: # xterm: the scrollback
+            self.history.clear()
+            self.scrollback_offset=0
+
+    def erase_line(self, params):
+        mode=param(params, 0, 0)
+        start=self.cursor[1]*self.width
+        i=start+self.cursor[0]
+        if mode==0:
+            self.display.erase(i, start+self.width)
+        elif mode==1:
+            self.display.erase(start, i+1)
+        elif mode==2:
+            self.display.erase(start, start+self.width)
+
+    def erase_chars(self, params):
+        i=self.cursor[1]*self.width+self.cursor[0]
+        self.display.erase(i, i+min(param(params),
+            self.width-self.cursor[0]))
+
+    def insert_chars(self, params):
+        self.display.insert_chars(self.cursor[1], self.cursor[0],
+            param(params))
+        self.wrap_pending=False
+
+    def delete_chars(self, params):
+        self.display.delete_chars(self.cursor[1], self.cursor[0],
+            param(params))
+        self.wrap_pending=False
+
+    def insert_lines(self, params):
+        top, bottom = self.scroll_range
+        if not top<=self.cursor[1]<=bottom: return
+        self.display.scroll_up([self.cursor[1], bottom], param(params))
+        self.move_to(0, self.cursor[1])
+
+    def delete_lines(self, params):
+        top, bottom = self.scroll_range
+        if not top<=self.cursor[1]<=bottom: return
+        self.display.scroll([self.cursor[1], bottom], param(params), False)
+        self.move_to(0, self.cursor[1])
+
+    def scroll_up(self, params):
+        self.display.scroll(self.scroll_range, param(params))
+
+    def scroll_down(self, params):
+        if len(params)>1: return # xterm mouse highlight tracking
+        self.display.scroll_up(self.scroll_range, param(params))
+
+    def select_graphic_rendition(self, params):
+        if not params:
+            params=[0]
+        i=0
+        while i<len(params):
+            p=params[i] or 0
+            if p in (0, 39):
+                self.style_lum=self.style2lum_dict[7]
+            elif 30<=p<=37:
+                self.style_lum=self.style2lum_dict[p-30]
+            elif 90<=p<=97:
+                self.style_lum=self.style2lum_dict[p-90]
+            elif p in (38, 48): # 256 colours as 5;n, true colour as 2;r;g;b
+                mode=param(params, i+1, None)
+                if p==38 and mode==5 and param(params, i+2, 0)<16:
+                    self.style_lum=self.style2lum_dict[
+                        param(params, i+2, 0)%8]
+                i+=mode==5 and 2 or mode==2 and 4 or 0
+            i+=1
+
+    def set_margins(self, params):
+        top=param(params, 0)-1
+        bottom=min(param(params, 1, self.height), self.height)-1
+        if top>=bottom: return
+        self.scroll_range=[top, bottom]
+        self.move_to(0, self.origin and top or 0)
+
+    def set_dec_modes(self, params, on=True):
+        for mode in params:
+            if mode==25:
+                self.cursor_visible=on
+            elif mode==7:
+                self.autowrap=on
+            elif mode==6:
+                self.origin=on
+                self.move_to(0, on and self.scroll_range[0] or 0)
+            elif mode in (47, 1047):
+                self.alternate_screen(on)
+            elif mode==1049:
+                self.alternate_screen(on, True)
+            elif mode==1048:
+                if on: self.save_cursor()
+                else: self.restore_cursor()
+            # the others, like cursor keys, mouse and bracketed paste, are
+            # for the keyboard, which is the real terminal's
+
+    def reset_dec_modes(self, params):
+        self.set_dec_modes(params, False)
+
+    def alternate_screen(self, on, save_cursor=False):
+        """Switches to a blank alternate screen, without scrollback, or
+        back to the main screen."""
+        if on==(self.main_display is not None): return
+        if on:
+            if save_cursor: self.save_cursor()
+            self.main_display=self.display
+            self.display=TermBuffer(self.width, self.height)
         else:
-            self.delta_transmit()
-        
+            self.display=self.main_display
+            self.main_display=None
+            if save_cursor: self.restore_cursor()
+
+    def device_status(self, params):
+        mode=param(params, 0, 0)
+        if mode==5:
+            self.respond("\x1b[0n")
+        elif mode==6:
+            self.respond("\x1b[%d;%dR" % (self.cursor[1]+1, self.cursor[0]+1))
+
+    def device_attributes(self, params):
+        self.respond("\x1b[?1;2c") # VT100 with advanced video option
+
+    def secondary_device_attributes(self, params):
+        self.respond("\x1b[>0;10;0c")
+
+    def save_cursor(self, params=None):
+        self.saved_cursor=(self.cursor[0], self.cursor[1], self.style_lum,
+            list(self.charsets), self.shift, self.origin, self.wrap_pending)
+
+    def restore_cursor(self, params=None):
+        if self.saved_cursor is None:
+            self.move_to(0, 0)
+            return
+        col, row, self.style_lum, charsets, self.shift, self.origin, \
+            wrap_pending = self.saved_cursor
+        self.charsets=list(charsets)
+        self.move_to(col, row)
+        self.wrap_pending=wrap_pending
+
+    def char_processor(self, data):
+        """Processes a chunk of terminal output of any length. A sequence
+        cut off at the end is completed by the next chunk."""
+        self.parser.feed(data)
+
+    def cursor_overlay(self):
+        """Returns the cursor as overlay for TermBuffer.delta_transmit while
+        it is in its visible blink phase, else None."""
+        if not (self.cursor_visible and self.cursor_blink_state) \
+                or self.scrollback_offset:
+            return None
+        return (self.cursor[1], self.cursor[0], self.visual_cursor)
+
     def stat_refresh(self):
+        if self.win_status is None: return # headless
         if not time.time()>self.last_stat+1:
             return
         self.last_stat=time.time()
-        self.status_print("Bytes: %sb/5s\tLatency: %.1fms"
-            %(sum(self.stat_outbits), self.display.latency*1000))
+        status="Bytes: %sb/5s\tLatency: %.1fms" % (sum(self.stat_outbits),
+            self.display.latency*1000)
+        if self.scrollback_offset:
+            status+="\tScrollback: -%d/%d" % (self.scrollback_offset,
+                len(self.history))
+        self.status_print(status)
         self.stat_outbits=self.stat_outbits[:len(self.stat_outbits)-1]
         self.stat_outbits.insert(0, 0) 
          
 
     def debug(self,message):
         message=str(message)
-        if not self.debug_mode: return
+        if not self.debug_mode or self.win_debug is None: return
         self.win_debug.scroll(-1)
         self.win_debug.addstr(0,0,str(self.debug_no)+' '+message)
         self.win_debug.refresh()
@@ -341,10 +1010,7 @@ class Terminal:
         self.win_status.refresh()
 
     def curses_init(self, stdscr):
-        self.last_stat=time.time()
         self.status_string=""
-        self.stat_interval=5
-        self.stat_outbits=[0]*int(self.stat_interval/self.cursor_blink_interval)
         curses.start_color()
         curses.noecho()
         curses.cbreak()
@@ -375,92 +1041,442 @@ class Terminal:
 
         self.win_term.bkgd(' ', curses.color_pair(1))
         self.win_term.border()
+        self.win_term.refresh()
+        self.mirror=CursesMirror(self.win_term, self.width, self.height)
 
         self.win_status=curses.newwin(1, twidth, theight-1, 0)
         self.win_status.bkgd(' ', curses.color_pair(3))
 
-    def run(self, stdscr):
-        self.curses_init(stdscr)
-        self.status_print("Connecting...")
-        time.sleep(.5)
+    def run(self, stdscr=None):
+        """Without stdscr the terminal runs headless, without curses."""
+        if stdscr is not None:
+            self.curses_init(stdscr)
+            self.status_print("Connecting...")
+            time.sleep(.5)
         self.board.clear() 
         self.board.set_luminance(7)
         signal.signal(signal.SIGINT, self.handler_sigint)
         
 
-        last_update=time.time()
-        self.last_blink=0
+        self.next_blink=time.time()
+        if self.async_mode:
+            self.run_async()
+        else:
+            self.run_select()
+        self.board.clear()
+        self.board.flush()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def output_received(self, data):
+        """Feeds output of the child process into the display."""
+        self.stat_outbits[0]+=len(data)
+        PTY_BYTES.inc(len(data))
+        if self.recorder is not None:
+            self.recorder.pty(data)
+        if self.history is not None:
+            total=self.history.total
+        with PARSE_TIME:
+            self.char_processor(data)
+        if self.scrollback_offset: # the view stays on the same rows
+            self.scrollback_offset=min(len(self.history),
+                self.scrollback_offset+self.history.total-total)
+        self.cursor_blink_state=True
+        self.next_blink=time.time()+self.cursor_blink_interval
+        self.scheduler.mark_dirty()
+
+    def timer_tick(self):
+        """Blinks the cursor and sends a frame if one is due. Returns the
+        seconds until it needs to be called again."""
+        self.stat_refresh()
+        self.board.poll()
+        for target in self.board.targets: # each repaired on its own
+            lost=target.take_lost()
+            if not lost: continue
+            if self.pixel_stream is not None:
+                self.pixel_stream.resend(target, lost)
+            else:
+                self.transmitted_display.resend(target, lost)
+        export_timeout=None
+        if self.exporter is not None:
+            export_timeout=self.exporter.poll()
+        now=time.time()
+        if now>=self.next_blink: # blinking cursor
+            self.next_blink=now+self.cursor_blink_interval
+            self.cursor_blink_state=not self.cursor_blink_state
+            if self.cursor_visible:
+                self.scheduler.mark_dirty()
+
+        if self.scheduler.due(now):
+            self.delta_transmit()
+            self.scheduler.frame_sent()
+        if self.mirror is not None and self.mirror_scheduler.due(now):
+            self.mirror_render()
+            self.mirror_scheduler.frame_sent()
+
+        board_timeout=self.board.poll() # sends what the pacer let through
+        now=time.time()
+        timeout=max(0, self.next_blink-now)
+        for t in (self.scheduler.timeout(now),
+                self.mirror_scheduler.timeout(now), board_timeout,
+                export_timeout):
+            if t is not None:
+                timeout=min(timeout, t)
+        return timeout
+
+    def waiting(self, fds):
+        """Returns fds and the sockets whose input timer_tick handles: the
+        replies of reliable targets and the metrics scrapes."""
+        fds=list(fds)
+        for target in self.board.targets:
+            if target.window is not None and target.sock is not None:
+                fds.append(target.sock)
+        if self.exporter is not None:
+            fds+=self.exporter.sockets()
+        return fds
+
+    def run_select(self):
+        fds=[sys.stdin, self.term]
         while(True):
-            timeout = self.last_blink-time.time()+self.cursor_blink_interval
-            if timeout < 0: timeout=0
+            timeout=self.timer_tick()
             try:
-                rl = select.select([sys.stdin, self.term], [], [], timeout)[0]
+                rl = select.select(self.waiting(fds), [], [], timeout)[0]
             #except KeyboardInterrupt:
             #    pass # work is done by handler_sigint
             #except select.error: # Interrupted system call, esp. by SIGWINCH
             #    continue
             except: continue
             #self.debug(self.scroll_range)
-            self.stat_refresh()
-            if rl==[]: # timeout for blinking cursor
-                self.last_blink=time.time()
-                self.cursor_refresh()
-                last_update=time.time()
-                if self.cursor_blink_state:
-                    self.cursor_blink_state=False
-                else:
-                    self.cursor_blink_state=True
-                continue
 
             for r in rl:
                 if r==sys.stdin:
-                    c = os.read(0,1)
-                    os.write(self.master,c)
+                    c = self.keyboard_input(os.read(0, READ_SIZE))
+                    if c: os.write(self.master,c)
                 elif r==self.term:
                     try:
-                        c = os.read(self.master, 1)
-                        self.stat_outbits[0]+=1
+                        with PTY_READ_TIME:
+                            c = os.read(self.master, READ_SIZE)
                     except:
-                        self.board.clear()
+                        c = ""
+                    if c=="":
                         return # end of terminal life
-                    self.char_processor(c)
-                    self.cursor_blink_state=True
-                    self.last_blink=0
+                    self.output_received(c)
+
+    def run_async(self):
+        """Like run_select, but PTY, stdin and board output are separate
+        asyncore channels. Board output never blocks, so the PTY is drained
+        even while the network stalls."""
+        channels={}
+        self.board.attach(channels)
+        pty_channel=PtyChannel(self, channels)
+        StdinChannel(pty_channel, channels)
+        if self.exporter is not None:
+            self.exporter.attach(channels)
+        while pty_channel.alive:
+            asyncore.loop(self.timer_tick(), map=channels, count=1)
+
+class Ticker(Terminal):
+    """Shows a feed of lines, like a log, as terminal.py --pipe: without a
+    PTY, a shell or the VT parser. Input is read in bulk and each line is
+    written straight into the bottom row of the screen, which scrolls up.
+    Lines longer than the screen is wide take several rows.
+
+    Rows are shown as they come, or at most rate per second. With smooth,
+    in pixel mode, each row scrolls in pixel row by pixel row from an extra
+    row below the screen. At most max_backlog rows wait; when the input
+    comes faster, the oldest are skipped."""
+    def __init__(self, width=board.DSP_WIDTH, height=board.DSP_HEIGHT,
+            smooth=False):
+        Terminal.__init__(self, width, height+(smooth and 1 or 0),
+            spawn=False)
+        self.smooth=smooth
+        self.rate=0 # rows per second, 0 is as they come
+        self.max_backlog=PIPE_BACKLOG
+        self.backlog=collections.deque()
+        self.partial="" # a line not yet ended
+        self.fd=None
+        self.next_row=0
+        self.offset=0 # smooth: pixel rows the entering row is scrolled in
+        self.entering=False # smooth: a row is in the extra row
+        self.cursor_visible=False
+        self.set_scrollback(0)
+
+    def open_input(self, path=None):
+        """Reads from path, or from stdin. A FIFO is opened for writing,
+        too, so that it does not end when a writer goes away (Linux)."""
+        if path is None:
+            self.fd=0
+        elif stat.S_ISFIFO(os.stat(path).st_mode):
+            self.fd=os.open(path, os.O_RDWR)
+        else:
+            self.fd=os.open(path, os.O_RDONLY)
+
+    def read_input(self):
+        """Reads what there is and queues its rows. Returns False at the
+        end of input."""
+        try:
+            data=os.read(self.fd, READ_SIZE)
+        except OSError, err:
+            if err.errno in (errno.EAGAIN, errno.EINTR): return True
+            raise
+        if not data:
+            if self.partial:
+                self.queue([self.partial])
+                self.partial=""
+            return False
+        lines=(self.partial+data).split("\n")
+        self.partial=lines.pop()
+        if len(self.partial)>self.width*self.height: # no end in sight
+            lines.append(self.partial)
+            self.partial=""
+        self.queue(lines)
+        return True
+
+    def queue(self, lines):
+        PIPE_LINES.inc(len(lines))
+        if len(lines)>self.max_backlog:
+            PIPE_SKIPPED.inc(len(lines)-self.max_backlog)
+            lines=lines[-self.max_backlog:]
+        for line in lines:
+            self.backlog.extend(self.rows(line))
+        while len(self.backlog)>self.max_backlog:
+            self.backlog.popleft()
+            PIPE_SKIPPED.inc()
 
-            if(time.time()-last_update>(1.0/self.fps)):
-                self.delta_transmit()
-                last_update=time.time()
-            
+    def rows(self, line):
+        line=PIPE_ESCAPE_RE.sub("", line.rstrip("\r")).expandtabs()
+        line=line.translate(PIPE_CELLS, UTF8_CONTINUATION)
+        return [line[i:i+self.width]
+            for i in range(0, len(line), self.width)] or [""]
+
+    def pending(self):
+        return self.backlog or self.entering
+
+    def advance(self, now):
+        """Shows the next row, or with smooth scrolls it one pixel row
+        further."""
+        if self.smooth:
+            if self.entering:
+                self.offset+=1
+                if self.offset==glyphs.GLYPH_HEIGHT:
+                    self.display.scroll([0, self.height-1])
+                    self.offset=0
+                    self.entering=False
+                self.scheduler.mark_dirty()
+            if not self.entering and self.backlog:
+                self.put_row(self.height-1, self.backlog.popleft())
+                self.entering=True
+            return
+        while self.backlog:
+            self.display.scroll([0, self.height-1])
+            self.put_row(self.height-1, self.backlog.popleft())
+            self.scheduler.mark_dirty()
+            if self.rate: return
+
+    def put_row(self, row, text):
+        if text:
+            self.display.write(row, 0, text, self.style_lum)
+
+    def delta_transmit(self):
+        if not self.smooth:
+            Terminal.delta_transmit(self)
+            return
+        t=time.time()
+        with ENCODE_TIME:
+            self.text_renderer.render(self.display)
+        o=self.offset*glyphs.BITMAP_STRIDE
+        self.pixel_stream.send(self.text_renderer.bitmap[o:
+            o+board.PIXEL_BYTES])
+        self.display.latency=time.time()-t
+        self.display.scrolls=[]
+
+    def timer_tick(self):
+        now=time.time()
+        if self.pending() and now>=self.next_row:
+            self.advance(now)
+            if self.rate:
+                interval=1.0/self.rate
+                if self.smooth:
+                    interval/=glyphs.GLYPH_HEIGHT
+                self.next_row+=interval
+                if self.next_row<now: # after a pause
+                    self.next_row=now+interval
+        timeout=Terminal.timer_tick(self)
+        if self.pending():
+            timeout=min(timeout, max(0, self.next_row-time.time()))
+        return timeout
+
+    def run(self):
+        """Runs until the input ends and all of it is shown, which stays on
+        the board, or until ^C, which clears it."""
+        self.board.clear()
+        self.board.set_luminance(7)
+        self.next_blink=time.time()
+        try:
+            self.run_select()
+        except KeyboardInterrupt:
+            self.board.clear()
+        self.board.flush()
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def run_select(self):
+        fds=[self.fd]
+        while True:
+            timeout=self.timer_tick()
+            if self.fd not in fds and not self.pending() \
+                    and not self.scheduler.dirty:
+                return
+            try:
+                rl=select.select(self.waiting(fds), [], [], timeout)[0]
+            except select.error:
+                continue
+            if self.fd in rl and not self.read_input():
+                fds.remove(self.fd)
 
 def usage():
-    print "Usage: terminal.py [host] [-c|--colored] [-d|--debug] [-p|--port]"
+    print "Usage: terminal.py [host ...] [-c|--colored] [-d|--debug]" \
+        " [-p|--port] [-f|--fps] [-a|--async]" \
+        " [-R|--reliable] [--metrics-json FILE] [--metrics-socket PATH]" \
+        " [--mirror-fps N] [--headless] [-P|--pixel] [--font PSF_FILE]" \
+        " [--keyframe SECONDS] [--record FILE] [--scrollback LINES]" \
+        " [--scrollback-mb MB] [--pace PACKETS] [--pace-bytes BYTES]"
+    print "       terminal.py [host ...] --pipe [--input FILE]" \
+        " [--rate LINES] [--smooth] [--backlog LINES] [options]"
     print
+    print "host may be unix:PATH for a simulator on a Unix socket. Given"
+    print "several hosts, all of them show the session; a slow or lossy one"
+    print "does not hold up the others, and with --reliable, writes lost by"
+    print "one host are resent to it alone."
+    print "--headless runs without the curses mirror of the board."
+    print "--pixel draws the text in the board's pixel mode, in the built-in"
+    print "font or the 8 pixel wide PC Screen Font given by --font. Unless"
+    print "--reliable, the whole bitmap is sent again every %g seconds, or" % (
+        pixelstream.KEYFRAME_INTERVAL)
+    print "every --keyframe seconds; 0 turns it off."
+    print "--record writes the session to FILE for replay.py."
+    print "The scrollback keeps %d lines in at most %d MB by default;" % (
+        history.SCROLLBACK_LINES, history.SCROLLBACK_BYTES/1024/1024)
+    print "shift page up and down page through it on the board."
+    print "At most %d packets per second go to each host, or --pace per" % (
+        board.PACE_PACKETS)
+    print "second and --pace-bytes bytes per second; 0 is no limit. Small"
+    print "edits like keystroke echo overtake queued redraws."
+    print "--pipe shows the lines of stdin, or of the file or FIFO --input,"
+    print "scrolling up from the bottom, without a shell; --rate LINES per"
+    print "second paces them and --smooth, in pixel mode, scrolls them in"
+    print "pixel row by pixel row. At most %d rows, or --backlog, wait;" % (
+        PIPE_BACKLOG)
+    print "older ones are skipped. It takes no --async."
 
 def main():
-    t=Terminal()
     port=board.NET_PORT
     host=board.NET_HOST
     dry_run=False
+    reliable=False
+    metrics_json=None
+    metrics_socket=None
+    headless=False
+    pixel=False
+    font=None
+    record=None
+    scrollback=history.SCROLLBACK_LINES
+    scrollback_bytes=history.SCROLLBACK_BYTES
+    packet_rate=board.PACE_PACKETS
+    byte_rate=None
+    input_path=None
+    keyframe_interval=None
     try:
         opts, args=getopt.gnu_getopt(sys.argv[1:],
-            "hcdp:y", ("help", "colored", "debug", "port=", "dry-run"))
+            "hcdp:yf:aRP", ("help", "colored", "debug", "port=", "dry-run",
+            "fps=", "async", "reliable", "metrics-json=",
+            "metrics-socket=", "mirror-fps=", "headless", "pixel",
+            "font=", "record=", "scrollback=", "scrollback-mb=", "pace=",
+            "pace-bytes=", "pipe", "input=", "rate=", "smooth", "backlog=",
+            "keyframe="))
     except getopt.GetoptError, err:
         print str(err)
         usage()
         sys.exit(1)
-    if(len(args)==1):
-        host=args[0]
-    if(len(args)>1):
-        usage()
-        sys.exit(1)
+    hosts=args or [host]
+    names=[o for o, a in opts]
+    if "--pipe" in names:
+        t=Ticker(smooth="--smooth" in names)
+    else:
+        t=Terminal()
     for o, a in opts:
         if o in ("-h", "--help"): usage(); return
         if o in ("-c", "--colored"): t.colored=True
-        if o in ("-p", "--port"): port=a
+        if o in ("-p", "--port"): port=int(a)
         if o in ("-d", "--debug"): t.debug_mode=True
-        if o in ("-r", "--remote"): host=a
+        if o in ("-r", "--remote"): hosts=[a]
         if o in ("-y", "--dry-run"): dry_run=True
-    t.connect(host, port, dry_run)
-    curses.wrapper(t.run)
+        if o in ("-f", "--fps"): t.fps=float(a)
+        if o in ("-a", "--async"): t.async_mode=True
+        if o in ("-R", "--reliable"): reliable=True
+        if o=="--metrics-json": metrics_json=a
+        if o=="--metrics-socket": metrics_socket=a
+        if o=="--mirror-fps": t.mirror_fps=float(a)
+        if o=="--headless": headless=True
+        if o in ("-P", "--pixel"): pixel=True
+        if o=="--font":
+            pixel=True
+            try:
+                font=glyphs.load_psf(a)
+            except (IOError, ValueError), err:
+                print str(err)
+                sys.exit(1)
+        if o=="--record": record=a
+        if o=="--scrollback": scrollback=int(a)
+        if o=="--scrollback-mb": scrollback_bytes=int(float(a)*1024*1024)
+        if o=="--pace": packet_rate=float(a)
+        if o=="--pace-bytes": byte_rate=float(a)
+        if o=="--keyframe": keyframe_interval=float(a)
+        if o=="--input": input_path=a
+        if o=="--rate": t.rate=float(a)
+        if o=="--smooth": pixel=True
+        if o=="--backlog": t.max_backlog=max(1, int(a))
+    if isinstance(t, Ticker):
+        if t.async_mode:
+            print "--pipe runs without --async"
+            usage()
+            sys.exit(1)
+        if t.smooth and not t.rate:
+            print "--smooth needs a --rate"
+            sys.exit(1)
+        try:
+            t.open_input(input_path)
+        except OSError, err:
+            print str(err)
+            sys.exit(1)
+    else:
+        t.set_scrollback(scrollback, scrollback_bytes)
+    t.connect(hosts, port, dry_run, reliable, packet_rate, byte_rate)
+    if record is not None:
+        t.record(record)
+    if pixel:
+        t.use_pixels(font, keyframe_interval)
+    if metrics_json is not None or metrics_socket is not None:
+        try:
+            t.exporter=metrics.Exporter(metrics.registry, metrics_json,
+                metrics_socket)
+        except (IOError, ValueError), err:
+            print str(err)
+            sys.exit(1)
+    if isinstance(t, Ticker):
+        t.run()
+        return
+    if not headless:
+        curses.wrapper(t.run)
+        return
+    attr=None
+    if os.isatty(0):
+        attr=termios.tcgetattr(0)
+        tty.setraw(0)
+    try:
+        t.run()
+    finally:
+        if attr is not None:
+            termios.tcsetattr(0, termios.TCSADRAIN, attr)
     
 if __name__=="__main__": main()
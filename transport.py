@@ -0,0 +1,82 @@
+"""Ways for a Board to reach the wall or a stand-in for it."""
+import socket
+import select
+import collections
+
+class SocketTransport:
+    """Datagrams over a socket to a fixed address."""
+    def __init__(self, sock, address):
+        self.sock=sock
+        self.address=address
+
+    def send(self, message):
+        """Drops a datagram that cannot be sent: it is lost, like any
+        datagram on the network, which the protocol has to cope with
+        anyway."""
+        try:
+            self.sock.sendto(message, self.address)
+        except socket.error:
+            pass
+
+    def recv(self):
+        """Returns the next reply, or None if there is none yet."""
+        if not select.select([self.sock], [], [], 0)[0]:
+            return None
+        try:
+            return self.sock.recv(4096)
+        except socket.error:
+            return None
+
+class UdpTransport(SocketTransport):
+    """The network protocol of the real board."""
+    def __init__(self, host, port):
+        SocketTransport.__init__(self,
+            socket.socket(socket.AF_INET, socket.SOCK_DGRAM), (host, port))
+
+class UnixTransport(SocketTransport):
+    """Datagrams to a simulator listening on a Unix socket."""
+    def __init__(self, path):
+        sock=socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind("") # autobind, so that replies can reach us
+        SocketTransport.__init__(self, sock, path)
+
+class LoopbackTransport:
+    """Hands datagrams directly to a Simulator in the same process."""
+    def __init__(self, simulator):
+        self.sock=None
+        self.address=None
+        self.simulator=simulator
+        self.replies=collections.deque()
+
+    def send(self, message):
+        if isinstance(message, memoryview):
+            message=message.tobytes()
+        reply=self.simulator.process(message)
+        if reply is not None:
+            self.replies.append(reply)
+
+    def recv(self):
+        if not self.replies: return None
+        return self.replies.popleft()
+
+class NullTransport:
+    """Discards datagrams, counting them."""
+    def __init__(self):
+        self.sock=None
+        self.address=None
+        self.packets=0
+        self.bytes=0
+
+    def send(self, message):
+        self.packets+=1
+        self.bytes+=len(message)
+
+    def recv(self):
+        return None
+
+def open_transport(host, port):
+    """Returns the transport for a host given on the command line: unix:PATH
+    for a Unix socket, anything else is a UDP host."""
+    if host.startswith("unix:"):
+        return UnixTransport(host[len("unix:"):])
+    return UdpTransport(host, port)
@@ -0,0 +1,262 @@
+"""A parser for the output of programs written for VT500 series terminals,
+after the state machine of Paul Williams (vt100.net/emu/dec_ansi_parser).
+
+Every state has a table with the action and the next state for each of
+the 256 byte values, so a byte costs two list lookups and one call. In the
+ground state, runs of printable bytes skip the table and go to the handler
+in one piece, as do single C0 controls and the runs inside strings.
+Parameters are parsed into integers as their digits arrive. Control
+sequences that are complete within a chunk are matched as a whole instead,
+and remembered parsed, so that the many repeated ones of full screen
+programs cost one dictionary lookup.
+
+Bytes 0x80-0x9f are not taken as C1 controls, since they are continuation
+bytes of UTF-8. In the ground state, bytes from 0x80 on are printed; in
+strings they are kept; elsewhere they are ignored.
+
+The handler gets:
+    print_run(text)
+    execute(code)                            a C0 control
+    esc_dispatch(intermediates, final)
+    csi_dispatch(params, intermediates, final)
+    osc_dispatch(data)
+    dcs_dispatch(params, intermediates, final, data)
+params is a list of integers, None where a parameter is left out.
+intermediates is a string, including a private marker like "?" of a
+control sequence; final is a character."""
+import re
+
+# states
+GROUND=0
+ESCAPE=1
+ESCAPE_INTERMEDIATE=2
+CSI_ENTRY=3
+CSI_PARAM=4
+CSI_INTERMEDIATE=5
+CSI_IGNORE=6
+DCS_ENTRY=7
+DCS_PARAM=8
+DCS_INTERMEDIATE=9
+DCS_PASSTHROUGH=10
+DCS_IGNORE=11
+OSC_STRING=12
+SOS_PM_APC_STRING=13
+STATES=14
+
+# actions
+IGNORE=0
+PRINT=1
+EXECUTE=2
+COLLECT=3
+PARAM=4
+ESC_DISPATCH=5
+CSI_DISPATCH=6
+PUT=7
+OSC_PUT=8
+
+STAY=-1 # next state of a byte that does not leave the state
+
+MAX_PARAMS=16 # further parameters are dropped
+MAX_PARAM=65535
+MAX_STRING=4096 # bytes of an OSC or DCS string, the rest is dropped
+
+# a printable run, a C0 control, or a whole plain control sequence:
+# private marker, parameters, an intermediate and the final character
+GROUND_RE=re.compile(r"([\x20-\x7e]+|[\x80-\xff]+)"
+    r"|([\x00-\x17\x19\x1c-\x1f])"
+    r"|\x1b\[([<=>?]?)([0-9;]*)([\x20-\x2f]?)([\x40-\x7e])")
+GROUND_TEXT=1
+GROUND_C0=2
+MAX_CACHED=4096 # parsed control sequences
+STRING_RE=re.compile(r"[\x20-\x7e\x80-\xff]+") # of OSC and DCS
+IGNORED_RE=re.compile(r"[^\x18\x1a\x1b]*") # up to the end of a string
+
+def build_table():
+    table=[[(IGNORE, STAY)]*256 for state in range(STATES)]
+    def add(state, codes, action, next_state=STAY):
+        for c in codes:
+            table[state][c]=(action, next_state)
+    c0=range(0x00, 0x18)+[0x19]+range(0x1c, 0x20)
+    high=range(0x80, 0x100)
+
+    add(GROUND, c0, EXECUTE)
+    add(GROUND, range(0x20, 0x7f)+high, PRINT)
+
+    add(ESCAPE, c0, EXECUTE)
+    add(ESCAPE, range(0x20, 0x30), COLLECT, ESCAPE_INTERMEDIATE)
+    add(ESCAPE, range(0x30, 0x7f), ESC_DISPATCH, GROUND)
+    add(ESCAPE, [ord("[")], IGNORE, CSI_ENTRY)
+    add(ESCAPE, [ord("]")], IGNORE, OSC_STRING)
+    add(ESCAPE, [ord("P")], IGNORE, DCS_ENTRY)
+    add(ESCAPE, [ord("X"), ord("^"), ord("_")], IGNORE, SOS_PM_APC_STRING)
+
+    add(ESCAPE_INTERMEDIATE, c0, EXECUTE)
+    add(ESCAPE_INTERMEDIATE, range(0x20, 0x30), COLLECT)
+    add(ESCAPE_INTERMEDIATE, range(0x30, 0x7f), ESC_DISPATCH, GROUND)
+
+    for state in (CSI_ENTRY, CSI_PARAM, CSI_INTERMEDIATE, CSI_IGNORE):
+        add(state, c0, EXECUTE)
+        add(state, range(0x40, 0x7f), CSI_DISPATCH, GROUND)
+    add(CSI_ENTRY, range(0x20, 0x30), COLLECT, CSI_INTERMEDIATE)
+    add(CSI_ENTRY, range(0x30, 0x3a)+[0x3b], PARAM, CSI_PARAM)
+    add(CSI_ENTRY, [0x3a], IGNORE, CSI_IGNORE)
+    add(CSI_ENTRY, range(0x3c, 0x40), COLLECT, CSI_PARAM)
+    add(CSI_PARAM, range(0x30, 0x3a)+[0x3b], PARAM)
+    add(CSI_PARAM, [0x3a]+range(0x3c, 0x40), IGNORE, CSI_IGNORE)
+    add(CSI_PARAM, range(0x20, 0x30), COLLECT, CSI_INTERMEDIATE)
+    add(CSI_INTERMEDIATE, range(0x20, 0x30), COLLECT)
+    add(CSI_INTERMEDIATE, range(0x30, 0x40), IGNORE, CSI_IGNORE)
+    add(CSI_IGNORE, range(0x40, 0x7f), IGNORE, GROUND)
+
+    for state in (DCS_ENTRY, DCS_PARAM, DCS_INTERMEDIATE):
+        add(state, range(0x40, 0x7f), IGNORE, DCS_PASSTHROUGH)
+    add(DCS_ENTRY, range(0x20, 0x30), COLLECT, DCS_INTERMEDIATE)
+    add(DCS_ENTRY, range(0x30, 0x3a)+[0x3b], PARAM, DCS_PARAM)
+    add(DCS_ENTRY, [0x3a], IGNORE, DCS_IGNORE)
+    add(DCS_ENTRY, range(0x3c, 0x40), COLLECT, DCS_PARAM)
+    add(DCS_PARAM, range(0x30, 0x3a)+[0x3b], PARAM)
+    add(DCS_PARAM, [0x3a]+range(0x3c, 0x40), IGNORE, DCS_IGNORE)
+    add(DCS_PARAM, range(0x20, 0x30), COLLECT, DCS_INTERMEDIATE)
+    add(DCS_INTERMEDIATE, range(0x20, 0x30), COLLECT)
+    add(DCS_INTERMEDIATE, range(0x30, 0x40), IGNORE, DCS_IGNORE)
+    add(DCS_PASSTHROUGH, c0+range(0x20, 0x7f)+high, PUT)
+
+    add(OSC_STRING, range(0x20, 0x7f)+high, OSC_PUT)
+    add(OSC_STRING, [0x07], IGNORE, GROUND) # BEL ends it, as in xterm
+
+    for state in range(STATES): # anywhere
+        add(state, [0x18, 0x1a], EXECUTE, GROUND)
+        add(state, [0x1b], IGNORE, ESCAPE)
+    return table
+
+TABLE=build_table()
+
+class Parser:
+    """Feeds chunks of output of any length to a handler; a sequence may
+    be split across chunks."""
+    def __init__(self, handler):
+        self.handler=handler
+        self.state=GROUND
+        self.actions=(self.ignore, self.print_byte, self.execute,
+            self.collect, self.param, self.esc_dispatch, self.csi_dispatch,
+            self.put, self.osc_put)
+        self.clear()
+        self.string=[] # of OSC and DCS
+        self.length=0
+        self.cached={} # control sequence -> csi_dispatch arguments
+
+    def feed(self, data):
+        pos=0
+        end=len(data)
+        actions=self.actions
+        while pos<end:
+            if self.state==GROUND:
+                m=GROUND_RE.match(data, pos)
+                if m is not None:
+                    pos=m.end()
+                    if m.lastindex==GROUND_TEXT:
+                        self.handler.print_run(m.group())
+                        continue
+                    if m.lastindex==GROUND_C0:
+                        self.handler.execute(ord(m.group()))
+                        continue
+                    sequence=self.cached.get(m.group())
+                    if sequence is None:
+                        sequence=self.parse_csi(m)
+                    self.handler.csi_dispatch(*sequence)
+                    continue
+            elif self.state in (OSC_STRING, DCS_PASSTHROUGH):
+                m=STRING_RE.match(data, pos)
+                if m is not None:
+                    self.put_run(m.group())
+                    pos=m.end()
+                    continue
+            elif self.state in (DCS_IGNORE, SOS_PM_APC_STRING):
+                pos=IGNORED_RE.match(data, pos).end()
+                if pos==end: break
+            c=ord(data[pos])
+            pos+=1
+            action, next_state = TABLE[self.state][c]
+            if next_state==STAY:
+                actions[action](c)
+                continue
+            # exit action, transition action, entry action
+            if self.state==OSC_STRING:
+                self.handler.osc_dispatch("".join(self.string))
+            elif self.state==DCS_PASSTHROUGH:
+                self.handler.dcs_dispatch(self.params(), self.intermediates,
+                    self.final, "".join(self.string))
+            actions[action](c)
+            self.state=next_state
+            if next_state in (ESCAPE, CSI_ENTRY, DCS_ENTRY):
+                self.clear()
+            elif next_state==OSC_STRING:
+                self.string=[]
+                self.length=0
+            elif next_state==DCS_PASSTHROUGH:
+                self.final=chr(c)
+                self.string=[]
+                self.length=0
+
+    def parse_csi(self, m):
+        """Returns the csi_dispatch arguments of a GROUND_RE match, the same
+        as the state machine would pass, and remembers them."""
+        values=[]
+        if m.group(4):
+            values=[min(MAX_PARAM, int(v)) if v else None
+                for v in m.group(4).split(";")]
+            if len(values)>MAX_PARAMS+1:
+                values=values[:MAX_PARAMS]+values[-1:]
+        sequence=(values, m.group(3)+m.group(5), m.group(6))
+        if len(self.cached)>=MAX_CACHED:
+            self.cached.clear()
+        self.cached[m.group()]=sequence
+        return sequence
+
+    def clear(self):
+        self.intermediates=""
+        self.values=[]
+        self.current=None
+        self.final=None
+
+    def params(self):
+        if self.current is None and not self.values:
+            return []
+        return self.values+[self.current]
+
+    def ignore(self, c):
+        pass
+
+    def print_byte(self, c):
+        self.handler.print_run(chr(c))
+
+    def execute(self, c):
+        self.handler.execute(c)
+
+    def collect(self, c):
+        self.intermediates+=chr(c)
+
+    def param(self, c):
+        if c==0x3b: # ;
+            if len(self.values)<MAX_PARAMS:
+                self.values.append(self.current)
+            self.current=None
+        else:
+            self.current=min(MAX_PARAM, (self.current or 0)*10+c-0x30)
+
+    def esc_dispatch(self, c):
+        self.handler.esc_dispatch(self.intermediates, chr(c))
+
+    def csi_dispatch(self, c):
+        self.handler.csi_dispatch(self.params(), self.intermediates, chr(c))
+
+    def put(self, c):
+        self.put_run(chr(c))
+
+    osc_put=put
+
+    def put_run(self, text):
+        if self.length<MAX_STRING:
+            text=text[:MAX_STRING-self.length]
+            self.string.append(text)
+            self.length+=len(text)